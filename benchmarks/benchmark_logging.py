@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Benchmark the daemon's logging path with synthetic load
+#
+# Builds an ExampleSmaxService around an ExampleHardwareInterface with a generated
+# logged_data config, and times logging_action and smax_logging_action against
+# either an in-process fake SMA-X client or a local redis-server. Each number of keys
+# is run for every combination of the --delay and --config-delay values, and each
+# run is made in a fresh process, so that its peak memory is its own.
+#
+# Usage:
+#   python benchmarks/benchmark_logging.py --keys 10 100 1000 10000 --output results.json
+#   python benchmarks/benchmark_logging.py --delay 0 0.0001 0.001 --config-delay 0 0.01
+#   python benchmarks/benchmark_logging.py --redis localhost:6379 --batch-share
+#   python benchmarks/benchmark_logging.py --compare old_results.json
+#
+# The smax, systemd-python and retrying packages must be installed, as they are
+# for the daemon itself.
+
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "smax_daemon"))
+
+
+class FakeSmaxClient:
+    """An in-process stand-in for SmaxRedisClient that stores shared values in a dictionary."""
+    def __init__(self):
+        self.values = {}
+        self.meta = {}
+        self.round_trips = 0
+
+    def _store(self, table, key, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self._store(":".join((table, key)), k, v)
+        else:
+            self.values[":".join((table, key))] = value
+
+    def smax_share(self, table, key, value):
+        self.round_trips += 1
+        self._store(table, key, value)
+
+    def smax_push_meta(self, meta, table, value):
+        self.round_trips += 1
+        self.meta[(meta, table)] = value
+
+    def smax_pull(self, table, key):
+        self.round_trips += 1
+        return self.values[":".join((table, key))]
+
+    def smax_subscribe(self, pattern, callback=None):
+        pass
+
+    def smax_unsubscribe(self, pattern=None):
+        pass
+
+    def smax_connect_to(self, *args, **kwargs):
+        pass
+
+    def smax_disconnect(self):
+        pass
+
+
+def generate_logged_data(n_keys, publish="always"):
+    """Generate a nested logged_data config with n_keys entries, cycling through
+    attributes, methods, methods with arguments and interface-derived values."""
+    kinds = [
+        {"attribute":"random_base", "type":"float"},
+        {"function":"random_number", "type":"float"},
+        {"function":"add_a_number", "args":[42], "type":"float"},
+        {"function":"random_range_plus_one", "type":"float"},
+        {"attribute":"random_base_minus_one", "type":"float"},
+    ]
+    logged_data = {}
+    for i in range(n_keys):
+        entry = dict(kinds[i % len(kinds)])
+        entry["publish"] = publish
+        logged_data.setdefault(f"group{i // 100}", {})[f"point{i}"] = entry
+    return logged_data
+
+
+def build_service(daemon, n_keys, delay, config_delay, args, workdir):
+    """Write the generated configs to workdir and create a service with its hardware and SMA-X client.
+
+    Returns the service, its device and the time taken to connect to and configure the hardware."""
+    config = {
+        "logging_interval":1,
+        "smax_config":{
+            "smax_key":"benchmark",
+            "smax_control_keys":{},
+            "batch_share":args.batch_share
+        },
+        "logged_data":generate_logged_data(n_keys, args.publish),
+        "config":{
+            "_delay":delay,
+            "_config_delay":config_delay
+        },
+        "smax_buffer":{
+            "path":os.path.join(workdir, f"smax_buffer_{os.getpid()}")
+        }
+    }
+    if args.workers:
+        config["concurrent_reads"] = {"max_workers":args.workers, "lock_scope":"point"}
+    server, port = args.redis.split(":") if args.redis else ("localhost", 6379)
+    smax_config = {"smax_server":server, "smax_port":int(port), "smax_db":0, "smax_table":"benchmark"}
+
+    config_file = os.path.join(workdir, f"daemon_config_{os.getpid()}.json")
+    smax_config_file = os.path.join(workdir, "smax_config.json")
+    with open(config_file, "w") as fp:
+        json.dump(config, fp)
+    with open(smax_config_file, "w") as fp:
+        json.dump(smax_config, fp)
+
+    service = daemon.ExampleSmaxService(config=config_file, smax_config=smax_config_file)
+    service.set_logging_level(logging.ERROR)
+    device = service.devices[0]
+    start = time.perf_counter()
+    device.hardware = daemon.HardwareInterface(config=device.config, logger=service.logger)
+    connect_time = time.perf_counter() - start
+    if not args.redis:
+        service.smax_client = FakeSmaxClient()
+    service.connect_to_smax()
+    service.open_smax_buffer()
+    return service, device, connect_time
+
+
+def time_calls(func, cycles):
+    """Call func cycles times, and return the wall clock times of each call and the total CPU time"""
+    times = []
+    cpu_start = time.process_time()
+    for _ in range(cycles):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times, time.process_time() - cpu_start
+
+
+def summarize(times, cpu, n_keys):
+    mean = statistics.mean(times)
+    return {
+        "cycle_mean_s":mean,
+        "cycle_median_s":statistics.median(times),
+        "cycle_min_s":min(times),
+        "cycle_max_s":max(times),
+        "keys_per_s":n_keys/mean if mean else None,
+        "cpu_fraction":cpu/sum(times) if sum(times) else None,
+    }
+
+
+def run_benchmark(n_keys, delay, config_delay, args, workdir):
+    """Benchmark one number of keys and hardware delays. Run in a fresh process by run_in_process()."""
+    # The daemon's log file is written to the working directory
+    os.chdir(workdir)
+    import example_smax_daemon as daemon
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    service, device, connect_time = build_service(daemon, n_keys, delay, config_delay, args, workdir)
+    gc.collect()
+
+    # Warm up, so that first-call costs are not counted
+    service.smax_logging_action(device)
+
+    hardware_times, hardware_cpu = time_calls(device.hardware.logging_action, args.cycles)
+    round_trips = getattr(service.smax_client, "round_trips", 0)
+    full_times, full_cpu = time_calls(lambda: service.smax_logging_action(device), args.cycles)
+    round_trips = getattr(service.smax_client, "round_trips", 0) - round_trips
+
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        "keys":n_keys,
+        "delay":delay,
+        "config_delay":config_delay,
+        "cycles":args.cycles,
+        "connect_s":connect_time,
+        "logging_action":summarize(hardware_times, hardware_cpu, n_keys),
+        "smax_logging_action":summarize(full_times, full_cpu, n_keys),
+        "smax_round_trips_per_cycle":round_trips/args.cycles if not args.redis else None,
+        "max_rss_kb":max_rss,
+        # The growth of the peak from the daemon's imports to the end of the run
+        "rss_growth_kb":max_rss - rss_before,
+    }
+
+    device.hardware.disconnect_hardware()
+    if args.redis:
+        service.smax_client.smax_disconnect()
+    return result
+
+
+def run_in_process(n_keys, delay, config_delay, args, workdir):
+    """Run run_benchmark() in a new interpreter, so that memory use is not carried over between runs"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_benchmark, (n_keys, delay, config_delay, args, workdir))
+
+
+def _run_name(r):
+    return f"{r['keys']:>6} keys, delay {r.get('delay')}, config delay {r.get('config_delay')}"
+
+
+def compare(results, baseline_file):
+    """Print the change in mean smax_logging_action cycle time relative to a previous run"""
+    with open(baseline_file) as fp:
+        baseline = {(r["keys"], r.get("delay"), r.get("config_delay")):r for r in json.load(fp)["results"]}
+    for r in results:
+        old = baseline.get((r["keys"], r["delay"], r["config_delay"]))
+        if old is not None:
+            old = old["smax_logging_action"]["cycle_mean_s"]
+            new = r["smax_logging_action"]["cycle_mean_s"]
+            print(f"{_run_name(r)}: {old*1e3:10.3f} ms -> {new*1e3:10.3f} ms ({(new - old)/old*100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the example SMA-X daemon logging path")
+    parser.add_argument("--keys", type=int, nargs="+", default=[10, 100, 1000, 10000], help="numbers of logged keys to benchmark")
+    parser.add_argument("--cycles", type=int, default=20, help="logging cycles to time for each number of keys")
+    parser.add_argument("--delay", type=float, nargs="+", default=[None], help="ExampleHardware _delay values for each random number, in seconds")
+    parser.add_argument("--config-delay", type=float, nargs="+", default=[None], help="ExampleHardware _config_delay values, in seconds")
+    parser.add_argument("--workers", type=int, default=0, help="use concurrent reads with this many workers")
+    parser.add_argument("--batch-share", action="store_true", help="write each cycle to SMA-X as a single struct")
+    parser.add_argument("--publish", default="always", choices=["always", "on_change"], help="publish policy for the generated keys")
+    parser.add_argument("--redis", default=None, help="HOST:PORT of a local redis-server to use instead of the fake SMA-X client")
+    parser.add_argument("--output", default=None, help="file to save the results to as JSON")
+    parser.add_argument("--compare", default=None, help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = []
+        for n_keys, delay, config_delay in itertools.product(args.keys, args.delay, args.config_delay):
+            result = run_in_process(n_keys, delay, config_delay, args, workdir)
+            results.append(result)
+            print(f"{_run_name(result)}: connect {result['connect_s']*1e3:10.3f} ms, "
+                  f"logging_action {result['logging_action']['cycle_mean_s']*1e3:10.3f} ms, "
+                  f"smax_logging_action {result['smax_logging_action']['cycle_mean_s']*1e3:10.3f} ms, "
+                  f"{result['smax_logging_action']['keys_per_s']:12.0f} keys/s, "
+                  f"max RSS {result['max_rss_kb']/1024:.1f} MB (+{result['rss_growth_kb']/1024:.1f} MB)")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({
+                "date":datetime.datetime.now().isoformat(),
+                "python":sys.version,
+                "platform":platform.platform(),
+                "settings":vars(args),
+                "results":results,
+            }, fp, indent=4)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,21 @@
 # This code is deliberately not threaded and blocks to simulate
 # I/O delays
 
+from functools import lru_cache
 import random
 import time
 
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """Return the numpy module, imported on first use, or None if NumPy is not installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
 class ExampleHardware:
     def __init__(self, config=None):
         """Create a simulated hardware object that returns random numbers in a certain range.
@@ -28,11 +40,19 @@ class ExampleHardware:
             
     def configure(self, config):
         """Configure the random number generator with a dictionary
-        keyed by the private attributes to set."""
+        keyed by the attributes to set.
         
-        for k in config.keys():
-            # no type checking or anything complex here
-            setattr(self, k, config[k])
+        The settings are applied together, with a single _config_delay rather than one per setter."""
+        delay = config.get("_config_delay", self._config_delay)
+        # Hold off the setters' own delays while the settings are applied
+        self._config_delay = None
+        try:
+            for k in config.keys():
+                # no type checking or anything complex here
+                if k != "_config_delay":
+                    setattr(self, k, config[k])
+        finally:
+            self._config_delay = delay
         
         if self._config_delay:
             time.sleep(self._config_delay)
@@ -43,6 +63,17 @@ class ExampleHardware:
             time.sleep(self._delay)
         return random.uniform(self._random_base, self._random_base+self._random_range)
     
+    def random_numbers(self, n):
+        """A function to return a block of n random numbers in a single read.
+        
+        Returns a NumPy array if NumPy is installed, otherwise a list."""
+        if self._delay:
+            time.sleep(self._delay)
+        np = _numpy()
+        if np is not None:
+            return np.random.uniform(self._random_base, self._random_base+self._random_range, n)
+        return [random.uniform(self._random_base, self._random_base+self._random_range) for _ in range(n)]
+    
     @property
     def random_base(self):
         """Getter for random base"""
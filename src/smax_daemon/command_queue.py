@@ -0,0 +1,133 @@
+# A coalescing queue for hardware control commands
+#
+# Control key callbacks put (attribute, value) commands on the queue and return
+# immediately. A worker thread takes all the pending commands at once and applies
+# them with a single call, so a burst of writes to the same attribute only applies
+# the last value, and writes to different attributes share one configure call.
+#
+# An attribute can be rate limited, in which case writes to it are held on the queue
+# until its minimum interval since the last write has passed.
+
+import threading
+from time import perf_counter_ns
+
+
+class CommandQueue:
+    """Coalescing queue of attribute writes, applied in batches by a worker thread."""
+    def __init__(self, apply, logger=None, metrics=None, name="Commands"):
+        """Create the queue. The worker thread is started by the first put().
+
+        Arguments:
+            apply (callable) : called by the worker with a dictionary of the pending values, keyed by attribute.
+
+        Keyword Arguments:
+            logger (logging.Logger) : logger for apply errors and status.
+            metrics (TimingMetrics) : metrics to record the command latency and apply time in.
+            name (str) : the name of the worker thread."""
+        self.apply = apply
+        self.logger = logger
+        self.metrics = metrics
+        self.name = name
+
+        # Number of commands applied, and number replaced by a later write before being applied
+        self.applied = 0
+        self.coalesced = 0
+
+        # attribute : (value, origin, time first queued in ns)
+        self._pending = {}
+        # attribute : minimum interval between writes in ns
+        self._min_interval = {}
+        # attribute : time of the last write in ns, for rate limited attributes
+        self._last_applied = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def depth(self):
+        """The number of attributes waiting to be written"""
+        return len(self._pending)
+
+    def set_rate_limit(self, attribute, rate):
+        """Limit writes to attribute to at most rate per second. If rate is None, remove the limit."""
+        with self._cond:
+            if rate:
+                self._min_interval[attribute] = int(1e9/rate)
+            else:
+                self._min_interval.pop(attribute, None)
+                self._last_applied.pop(attribute, None)
+
+    def _ready_time(self, attribute):
+        """The time in ns at which a pending write to attribute may be applied"""
+        if attribute not in self._min_interval or attribute not in self._last_applied:
+            return 0
+        return self._last_applied[attribute] + self._min_interval[attribute]
+
+    def put(self, attribute, value, origin=None):
+        """Queue a write of value to attribute, replacing any pending write to the same attribute.
+        Writes put after close() are dropped."""
+        with self._cond:
+            if self._closed:
+                if self.logger:
+                    self.logger.warning(f'{self.name} closed, dropped write of {value} to {attribute} from {origin}')
+                return
+            if attribute in self._pending:
+                self.coalesced += 1
+                queued = self._pending[attribute][2]
+            else:
+                queued = perf_counter_ns()
+            self._pending[attribute] = (value, origin, queued)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, daemon=True, name=self.name)
+                self._thread.start()
+            self._cond.notify()
+
+    def close(self, timeout=None):
+        """Stop the worker thread, dropping any pending writes, and wait up to timeout seconds for
+        it to finish a write it is applying."""
+        with self._cond:
+            self._closed = True
+            self._pending = {}
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    now = perf_counter_ns()
+                    ready = {a:p for a, p in self._pending.items() if self._ready_time(a) <= now}
+                    if ready:
+                        break
+                    if self._pending:
+                        # Only rate limited writes are pending, so wait until the first is due
+                        self._cond.wait((min(self._ready_time(a) for a in self._pending) - now)/1e9)
+                    else:
+                        self._cond.wait()
+                for attribute in ready:
+                    del self._pending[attribute]
+                    if attribute in self._min_interval:
+                        self._last_applied[attribute] = now
+                pending = ready
+
+            start = perf_counter_ns()
+            try:
+                self.apply({attribute:value for attribute, (value, _, _) in pending.items()})
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f'Failed to apply {", ".join(pending)} with {e!r}')
+                continue
+            done = perf_counter_ns()
+
+            self.applied += len(pending)
+            if self.metrics:
+                self.metrics.phase("command_apply", done - start)
+                for _, _, queued in pending.values():
+                    self.metrics.phase("command_latency", done - queued)
+            if self.logger:
+                for attribute, (value, origin, _) in pending.items():
+                    self.logger.status(f'{origin} set {attribute} to {value}')
@@ -0,0 +1,269 @@
+# Compile and validate the daemon configuration
+#
+# daemon_config.json and smax_config.json are merged, split into the config for
+# each device, their logged_data flattened, and the result checked for errors, so
+# that a bad config stops the daemon at startup rather than on the first logging
+# cycle.
+#
+# The compiled config is cached as JSON. The cache is reused while the config files
+# have the same modification time and size, or failing that the same contents, so a
+# restart with unchanged config files skips merging, flattening and validation.
+
+import hashlib
+import json
+import numbers
+import os
+
+# Change when the layout of the compiled config changes, to ignore old caches
+CONFIG_CACHE_VERSION = 4
+
+
+class ConfigError(ValueError):
+    """The daemon configuration is invalid. `problems` lists everything that was found wrong with it."""
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("Invalid configuration:\n\t" + "\n\t".join(problems))
+
+
+def _file_signature(path):
+    """Return [path, mtime in ns, size] for a config file"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def _file_hash(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def _is_positive_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and value > 0
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _check_device(device, problems):
+    """Check the config for one device, appending any problems found"""
+    # Imported here, so that the hardware interface is only loaded when the config has changed
+    from example_hardware_interface import control_types, control_target_error, logged_data_target_error
+    from example_smax_hardware import ExampleHardware
+    from publish_policy import PublishPolicy
+
+    name = device["smax_key"]
+    config = device["config"]
+
+    def section(key):
+        """Return the settings object config[key], or {} after noting a problem if it isn't one"""
+        value = config.get(key, {})
+        if isinstance(value, dict):
+            return value
+        problems.append(f"{name}: {key} must be an object of settings")
+        return {}
+
+    concurrent_reads = section("concurrent_reads")
+    if concurrent_reads.get("lock_scope", "device") not in ("device", "channel", "point"):
+        problems.append(f"{name}: unknown concurrent_reads lock_scope {concurrent_reads['lock_scope']}")
+    if not _is_count(concurrent_reads.get("max_workers", 0)):
+        problems.append(f"{name}: concurrent_reads max_workers must be a non-negative integer")
+
+    publish_policy = config.get("publish_policy", None)
+    if publish_policy is not None and not isinstance(publish_policy, dict):
+        problems.append(f"{name}: publish_policy must be an object of settings")
+        publish_policy = None
+    try:
+        default_policy = PublishPolicy.from_config(publish_policy)
+    except ValueError as e:
+        problems.append(f"{name}: publish_policy: {e}")
+        default_policy = None
+
+    load_shedding = section("load_shedding")
+    if not _is_positive_number(load_shedding.get("budget", 0.8)):
+        problems.append(f"{name}: load_shedding budget must be a positive number")
+    if not (_is_positive_number(load_shedding.get("max_backoff", 8)) and load_shedding.get("max_backoff", 8) >= 1):
+        problems.append(f"{name}: load_shedding max_backoff must be at least 1")
+    if not _is_count(section("history").get("samples", 0)):
+        problems.append(f"{name}: history samples must be a non-negative integer")
+    section("hardware_process")
+    section("hardware_cache")
+
+    for key, entry in config["logged_data"].items():
+        if entry is not None and not isinstance(entry, dict):
+            problems.append(f"{name}: logged_data {key}: must be an object of options, or null")
+            continue
+        error = logged_data_target_error(key, entry)
+        if error:
+            problems.append(f"{name}: logged_data {key}: {error}")
+        if entry is None:
+            continue
+        if "interval" in entry and not _is_positive_number(entry["interval"]):
+            problems.append(f"{name}: logged_data {key}: interval must be a positive number")
+        if "samples" in entry and not (isinstance(entry["samples"], int) and entry["samples"] > 0):
+            problems.append(f"{name}: logged_data {key}: samples must be a positive integer")
+        if "priority" in entry and not (isinstance(entry["priority"], numbers.Real) and not isinstance(entry["priority"], bool)):
+            problems.append(f"{name}: logged_data {key}: priority must be a number")
+        if "history" in entry and not _is_count(entry["history"]):
+            problems.append(f"{name}: logged_data {key}: history must be a non-negative integer")
+        try:
+            PublishPolicy.from_config(entry, default_policy)
+        except ValueError as e:
+            problems.append(f"{name}: logged_data {key}: {e}")
+
+    if not isinstance(device["control_keys"], dict):
+        problems.append(f"{name}: smax_control_keys must be an object")
+        return
+    for key, binding in device["control_keys"].items():
+        if isinstance(binding, str):
+            continue
+        if not isinstance(binding, dict) or not ("attribute" in binding or "function" in binding):
+            problems.append(f"{name}: control key {key} must name a callback, or give an attribute or function")
+            continue
+        if "type" in binding and binding["type"] not in control_types:
+            problems.append(f"{name}: control key {key}: unknown type {binding['type']}")
+        function = "function" in binding
+        error = control_target_error(ExampleHardware, binding["function" if function else "attribute"], function)
+        if error:
+            problems.append(f"{name}: control key {key}: {error}")
+
+
+def compile_config(config_file, smax_config_file=None):
+    """Read, merge and validate the daemon config files.
+
+    Arguments:
+        config_file (str) : path to daemon_config.json
+
+    Keyword Arguments:
+        smax_config_file (str) : path to smax_config.json, whose settings are merged into smax_config.
+
+    Returns:
+        dict : "config" is the merged top level config, and "devices" is a list of dictionaries
+            giving the "smax_key", "control_keys" and "config" of each device, with logged_data flattened.
+
+    Raises:
+        ConfigError : if the config is invalid."""
+    from example_hardware_interface import flatten_logged_data
+
+    with open(config_file) as fp:
+        config = json.load(fp)
+
+    # If smax_config is given, update the hardware specific config file with the smax_config
+    config.setdefault("smax_config", {})
+    if smax_config_file:
+        with open(smax_config_file) as fp:
+            s_config = json.load(fp)
+        if "smax_table" in config["smax_config"] and "smax_table" in s_config:
+            smax_root = s_config["smax_table"]
+            config["smax_config"]["smax_table"] = ":".join([smax_root, config["smax_config"]["smax_table"]])
+            del s_config["smax_table"]
+        config["smax_config"].update(s_config)
+
+    problems = []
+    for k in ("smax_server", "smax_port", "smax_db", "smax_table"):
+        if k not in config["smax_config"]:
+            problems.append(f"smax_config: missing {k}")
+    if not _is_positive_number(config.get("logging_interval", None)):
+        problems.append("logging_interval must be a positive number")
+    if config.get("service_mode", "thread") not in ("thread", "asyncio"):
+        problems.append(f"unknown service_mode {config['service_mode']}")
+    if not isinstance(config.get("align_sampling", False), bool):
+        problems.append("align_sampling must be true or false")
+    profiling = config.get("profiling", {})
+    if not isinstance(profiling, dict):
+        problems.append("profiling must be an object of settings")
+        profiling = {}
+    for k in ("duration", "interval"):
+        if k in profiling and not _is_positive_number(profiling[k]):
+            problems.append(f"profiling {k} must be a positive number")
+    if config.get("metrics_interval", None) is not None and not _is_positive_number(config["metrics_interval"]):
+        problems.append("metrics_interval must be a positive number")
+
+    # Each device's config is the top level config, updated with the device's section.
+    # Without a "devices" list, the top level config describes a single device.
+    if "devices" in config:
+        sections = config["devices"]
+        if not isinstance(sections, list):
+            problems.append("devices must be a list of device settings")
+            sections = []
+    elif "smax_key" in config["smax_config"]:
+        sections = [{"smax_key":config["smax_config"]["smax_key"],
+                     "smax_control_keys":config["smax_config"].get("smax_control_keys", {})}]
+    else:
+        sections = []
+        problems.append("smax_config: missing smax_key")
+    defaults = {k:v for k, v in config.items() if k not in ("devices", "smax_config")}
+
+    devices = []
+    for i, section in enumerate(sections):
+        if not isinstance(section, dict):
+            problems.append(f"devices[{i}]: must be an object of settings")
+            continue
+        if "smax_key" not in section:
+            problems.append(f"devices[{i}]: missing smax_key")
+            continue
+        if any(section["smax_key"] == d["smax_key"] for d in devices):
+            problems.append(f"duplicate device smax_key {section['smax_key']}")
+            continue
+        device_config = dict(defaults)
+        device_config.update(section)
+        logged_data = device_config.get("logged_data", {})
+        if not isinstance(logged_data, dict):
+            problems.append(f"{section['smax_key']}: logged_data must be an object")
+            logged_data = {}
+        device_config["logged_data"] = flatten_logged_data(logged_data)
+        device = {"smax_key":section["smax_key"],
+                  "control_keys":section.get("smax_control_keys", {}),
+                  "config":device_config}
+        _check_device(device, problems)
+        devices.append(device)
+
+    if problems:
+        raise ConfigError(problems)
+    return {"config":config, "devices":devices}
+
+
+def load_config(config_file, smax_config_file=None, cache_file=None):
+    """Return the compiled config, from cache_file if the config files haven't changed since it was written.
+
+    Arguments and return value are as for compile_config(). If cache_file is None, the config is always compiled.
+    Failing to write the cache is not an error."""
+    files = [f for f in (config_file, smax_config_file) if f]
+    signatures = [_file_signature(f) for f in files]
+
+    cache = None
+    if cache_file:
+        try:
+            with open(cache_file) as fp:
+                cache = json.load(fp)
+            if cache.get("version") != CONFIG_CACHE_VERSION or [f[0] for f in cache["files"]] != [s[0] for s in signatures]:
+                cache = None
+        except (OSError, ValueError, KeyError, TypeError):
+            cache = None
+
+    if cache is not None:
+        if [f[:3] for f in cache["files"]] == signatures:
+            return cache["compiled"]
+        # The files have been touched, but may not have changed
+        hashes = [_file_hash(f) for f in files]
+        if [f[3] for f in cache["files"]] == hashes:
+            compiled = cache["compiled"]
+            _write_cache(cache_file, signatures, hashes, compiled)
+            return compiled
+
+    compiled = compile_config(config_file, smax_config_file)
+    if cache_file:
+        _write_cache(cache_file, signatures, [_file_hash(f) for f in files], compiled)
+    return compiled
+
+
+def _write_cache(cache_file, signatures, hashes, compiled):
+    """Atomically replace cache_file with the compiled config"""
+    cache = {"version":CONFIG_CACHE_VERSION,
+             "files":[s + [h] for s, h in zip(signatures, hashes)],
+             "compiled":compiled}
+    try:
+        with open(cache_file + ".tmp", "w") as fp:
+            json.dump(cache, fp)
+        os.replace(cache_file + ".tmp", cache_file)
+    except (OSError, TypeError, ValueError):
+        pass
@@ -0,0 +1,108 @@
+# Connection state for the daemon's links to the hardware and to SMA-X
+#
+# A link is "connected" while everything works, "degraded" while it is up but
+# some reads or writes are failing, and "reconnecting" while a background thread
+# tries to re-establish it, with jittered exponential backoff. Nothing waits for
+# a reconnection - the logging loop checks the state and carries on without the
+# link until it is connected again.
+
+import random
+import threading
+
+
+class Link:
+    """The state of a connection, and the background thread that re-establishes it when it is lost."""
+    CONNECTED = "connected"
+    DEGRADED = "degraded"
+    RECONNECTING = "reconnecting"
+
+    def __init__(self, name, reconnect, logger=None, initial_delay=1.0, max_delay=30.0):
+        """Create a link in the reconnecting state. Nothing is done until connected() or lost() is called.
+
+        Arguments:
+            name (str) : the name of the link, for log messages and the reconnect thread.
+            reconnect (callable) : called with no arguments on the reconnect thread to re-establish the link.
+                Raises an exception if it fails, and is retried after a backoff delay.
+
+        Keyword Arguments:
+            logger (logging.Logger) : logger for state changes.
+            initial_delay (float) : the delay in seconds before the first retry. Doubles after each failure.
+            max_delay (float) : the longest delay in seconds between retries.
+                Each delay is randomly reduced by up to half, so that several daemons don't retry in step."""
+        self.name = name
+        self.reconnect = reconnect
+        self.logger = logger
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+        self.state = self.RECONNECTING
+        # The last error, or None
+        self.error = None
+        # Number of times the link has been lost
+        self.losses = 0
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        # Incremented each time the link is lost, so the reconnect thread can tell if it
+        # was lost again while it was reconnecting
+        self._generation = 0
+
+    def _set_state(self, state, error=None):
+        """Change state, logging the change. Must hold the lock."""
+        if state != self.state and self.logger:
+            if error is None:
+                self.logger.status(f'{self.name} link {state}')
+            else:
+                self.logger.warning(f'{self.name} link {state}: {error}')
+        self.state = state
+        self.error = error
+
+    def connected(self):
+        """Mark the link as connected and working"""
+        with self._lock:
+            self._set_state(self.CONNECTED)
+
+    def degraded(self, error):
+        """Mark the link as up, but with some failures"""
+        with self._lock:
+            self._set_state(self.DEGRADED, error)
+
+    def lost(self, error):
+        """Mark the link as lost, and start reconnecting in the background if not already doing so"""
+        with self._lock:
+            self.losses += 1
+            self._generation += 1
+            self._set_state(self.RECONNECTING, error)
+            self._stop.clear()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._reconnect_loop, daemon=True, name=f'{self.name} reconnect')
+                self._thread.start()
+
+    def close(self):
+        """Stop reconnecting"""
+        self._stop.set()
+
+    def _reconnect_loop(self):
+        delay = self.initial_delay
+        while True:
+            with self._lock:
+                if self._stop.is_set():
+                    self._thread = None
+                    return
+            generation = self._generation
+            try:
+                self.reconnect()
+            except Exception as e:
+                with self._lock:
+                    self._set_state(self.RECONNECTING, repr(e))
+                self._stop.wait(delay*random.uniform(0.5, 1.0))
+                delay = min(delay*2, self.max_delay)
+                continue
+            with self._lock:
+                if generation == self._generation:
+                    self._set_state(self.CONNECTED)
+                    self._thread = None
+                    return
+            # Lost again while reconnecting, so try again straight away
+            delay = self.initial_delay
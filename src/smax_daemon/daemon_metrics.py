@@ -0,0 +1,72 @@
+# Timing metrics for the daemon's hot paths
+#
+# Timings are recorded in nanoseconds from time.perf_counter_ns() into rolling
+# windows, and summarized as percentiles in milliseconds when published.
+
+from collections import deque
+
+
+class RollingHistogram:
+    """A rolling window of timing samples in nanoseconds."""
+    __slots__ = ("_samples", "count", "overruns")
+
+    def __init__(self, size=1024):
+        """Keyword Arguments:
+            size (int) : the number of most recent samples to keep."""
+        self._samples = deque(maxlen=size)
+        self.count = 0
+        self.overruns = 0
+
+    def add(self, ns):
+        """Add a sample in nanoseconds"""
+        self._samples.append(ns)
+        self.count += 1
+
+    def summary(self):
+        """Return a dictionary of the p50, p95, p99 and max of the samples in the window in
+        milliseconds, along with the total sample and overrun counts."""
+        samples = sorted(self._samples)
+        n = len(samples)
+        summary = {"count":self.count, "overruns":self.overruns}
+        if n:
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                summary[name] = samples[min(int(q*n), n - 1)]/1e6
+            summary["max"] = samples[-1]/1e6
+        return summary
+
+
+class TimingMetrics:
+    """Rolling timing histograms for the phases of the logging cycle and for each logged key,
+    along with any counters to be published with them."""
+    def __init__(self, size=1024):
+        """Keyword Arguments:
+            size (int) : the number of most recent samples to keep for each histogram."""
+        self.size = size
+        self.phases = {}
+        self.keys = {}
+        # Other counts to publish with the timings, such as cache hits
+        self.counters = {}
+
+    def _histogram(self, table, name):
+        try:
+            return table[name]
+        except KeyError:
+            return table.setdefault(name, RollingHistogram(self.size))
+
+    def phase(self, name, ns):
+        """Record a timing in nanoseconds for a phase such as "hardware_read" or "smax_write"."""
+        self._histogram(self.phases, name).add(ns)
+
+    def key(self, name, ns):
+        """Record a read timing in nanoseconds for a logged key."""
+        self._histogram(self.keys, name).add(ns)
+
+    def overrun(self, name, count=1):
+        """Count overruns of a phase's time budget."""
+        self._histogram(self.phases, name).overruns += count
+
+    def summary(self):
+        """Return the summaries of all the histograms as a dictionary suitable for sharing as an SMA-X struct."""
+        return {"phases":{name:h.summary() for name, h in list(self.phases.items())},
+                "keys":{name:h.summary() for name, h in list(self.keys.items())},
+                "counters":dict(self.counters)}
@@ -0,0 +1,173 @@
+# On-demand profiling of a running daemon
+#
+# A Profiler samples the Python stacks of the daemon's threads with
+# sys._current_frames() for a fixed time, and optionally traces memory allocations
+# with tracemalloc over the same time. Sampling costs nothing until it is started
+# and little while it runs, so the daemon can be profiled in production without a
+# restart or a change of logging level.
+#
+# The results are written to a text report and a collapsed stack file (one
+# "frame;frame;frame count" line per stack, as read by flamegraph.pl and
+# speedscope), and a summary is passed to a callback.
+
+from collections import Counter
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Samples whose innermost Python frame is in one of these modules are counted as idle, waiting for work
+_idle_modules = ("threading.py", "selectors.py", "queue.py", os.path.join("concurrent", "futures", "thread.py"),
+                 os.path.join("logging", "handlers.py"))
+
+
+def _frame_name(code, lineno):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+class Profiler:
+    """A sampling profiler and memory tracer that runs for a fixed time on its own thread."""
+    def __init__(self, directory, prefix, logger=None, on_done=None):
+        """Arguments:
+            directory (str) : the directory to write the results to.
+            prefix (str) : the start of the result file names, which are followed by the time the profile started.
+
+        Keyword Arguments:
+            logger (logging.Logger) : logger for the start and end of each profile.
+            on_done (callable) : called with the summary dictionary when a profile finishes."""
+        self.directory = directory
+        self.prefix = prefix
+        self.logger = logger
+        self.on_done = on_done
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, duration=10, top=20, interval=0.005, threads=None, memory=True):
+        """Start a profile in the background, unless one is already running.
+
+        Keyword Arguments:
+            duration (float) : how long to profile for in seconds.
+            top (int) : the number of functions and allocation sites to list in the summary.
+            interval (float) : the time between stack samples in seconds.
+            threads (list) : profile only threads whose names start with one of these strings. None profiles all threads.
+            memory (bool) : if True, also trace memory allocations with tracemalloc.
+
+        Returns:
+            bool : True if the profile was started, False if one was already running."""
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._thread = threading.Thread(target=self._run, args=(duration, top, interval, threads, memory),
+                                            daemon=True, name="Profiler")
+            self._thread.start()
+        return True
+
+    def _run(self, duration, top, interval, threads, memory):
+        try:
+            summary = self._profile(duration, top, interval, threads, memory)
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'Profiling failed with {e!r}')
+            summary = None
+        with self._lock:
+            self._thread = None
+        if summary is not None and self.on_done is not None:
+            self.on_done(summary)
+
+    def _profile(self, duration, top, interval, threads, memory):
+        """Run a profile, write the result files and return the summary"""
+        started = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+        if self.logger:
+            self.logger.status(f'Profiling for {duration} s')
+
+        started_tracing = False
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            start_snapshot = tracemalloc.take_snapshot()
+
+        stacks, samples, idle = self._sample(duration, interval, threads)
+
+        memory_top = memory_growth = None
+        if memory:
+            end_snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            filters = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+            end_snapshot = end_snapshot.filter_traces(filters)
+            memory_top = [str(s) for s in end_snapshot.statistics("lineno")[:top]]
+            memory_growth = [str(s) for s in end_snapshot.compare_to(start_snapshot.filter_traces(filters), "lineno")[:top]]
+
+        # Time spent in each function, and in each function and the functions it called,
+        # leaving out the thread's name and the threading module frames at the base of every stack
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                if "(threading.py:" not in frame:
+                    total[frame] += count
+        busy = max(samples - idle, 1)
+        summary = {"started":time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+                   "duration":duration,
+                   "samples":samples,
+                   "idle_samples":idle,
+                   "top_own":[f"{100*n/busy:.1f}% {name}" for name, n in own.most_common(top)],
+                   "top_total":[f"{100*n/busy:.1f}% {name}" for name, n in total.most_common(top)]}
+        if memory:
+            summary["memory_top"] = memory_top
+            summary["memory_growth"] = memory_growth
+
+        base = os.path.join(self.directory, f"{self.prefix}_profile_{stamp}")
+        with open(base + ".folded", "w") as fp:
+            for stack, count in stacks.items():
+                fp.write(f"{';'.join(stack)} {count}\n")
+        with open(base + ".txt", "w") as fp:
+            fp.write(f"Profile started {summary['started']} for {duration} s, {samples} samples of which {idle} idle\n")
+            for title, lines in (("Own time (% of busy samples)", summary["top_own"]),
+                                 ("Total time (% of busy samples)", summary["top_total"]),
+                                 ("Largest allocations made while profiling", memory_top or []),
+                                 ("Memory growth while profiling", memory_growth or [])):
+                fp.write(f"\n{title}:\n")
+                fp.writelines(f"\t{line}\n" for line in lines)
+        summary["files"] = [base + ".txt", base + ".folded"]
+        if self.logger:
+            self.logger.status(f'Profile written to {base}.txt')
+        return summary
+
+    def _sample(self, duration, interval, threads):
+        """Sample the stacks of the selected threads every interval seconds for duration seconds.
+
+        Returns:
+            (Counter, int, int) : the sample count of each stack, as a tuple of the thread name followed by
+                the frames outermost first, and the total and idle sample counts."""
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        idle = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            names = {t.ident:t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == me or (threads is not None and not name.startswith(tuple(threads))):
+                    continue
+                samples += 1
+                if frame.f_code.co_filename.endswith(_idle_modules):
+                    idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(name)
+                stacks[tuple(reversed(stack))] += 1
+            time.sleep(interval)
+        return stacks, samples, idle
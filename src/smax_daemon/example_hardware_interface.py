@@ -1,14 +1,42 @@
 from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from functools import lru_cache, partial
+from operator import attrgetter
+import inspect
+import logging
+import math
+import time
+from time import perf_counter_ns
 import types
 import threading
 import smax
 
 from example_smax_hardware import ExampleHardware
+from daemon_metrics import TimingMetrics
+from command_queue import CommandQueue
+from hardware_proxy import HardwareProxy
+from connection_link import Link
+from sample_history import SampleHistory
+from load_shedding import LoadShedder
+from publish_policy import PublishPolicy
+from read_cache import ReadCache
 
 leaf_keys = [
     "function",
     "attribute",
-    "type"
+    "type",
+    "interval",
+    "channel",
+    "timeout",
+    "publish",
+    "deadband",
+    "deadband_rel",
+    "max_silence",
+    "cache",
+    "samples",
+    "raw",
+    "history",
+    "priority"
 ]
 leaf_keys.extend(smax.optional_metadata)
 
@@ -20,8 +48,9 @@ def flatten_logged_data(dictionary, parent_key="", separator=":"):
     for key, value in dictionary.items():
         new_key = parent_key + separator + key if parent_key else key
         if isinstance(value, MutableMapping):
-            # Detect if we have a leaf node
-            if value is None or len(value) == 0 or any(key for key in leaf_keys if key in value.keys()):
+            # Detect if we have a leaf node. An option name only marks a leaf if its value is not itself
+            # a mapping, so that groups can have members named like options, such as "channel"
+            if len(value) == 0 or any(not isinstance(value[key], MutableMapping) for key in leaf_keys if key in value):
                 items.append((new_key, value))
             else:
                 items.extend(flatten_logged_data(value, new_key, separator=separator).items())
@@ -30,28 +59,235 @@ def flatten_logged_data(dictionary, parent_key="", separator=":"):
     return dict(items)
 
 
+def _to_bool(value):
+    """Convert a control value to a bool, accepting strings such as "true" and "off"."""
+    if isinstance(value, str):
+        if value.strip().lower() in ("true", "yes", "on", "1"):
+            return True
+        if value.strip().lower() in ("false", "no", "off", "0"):
+            return False
+        raise ValueError(f"Can not convert {value!r} to bool")
+    return bool(value)
+
+
+# Type coercions for declarative control key bindings
+control_types = {
+    "float":float,
+    "int":int,
+    "str":str,
+    "bool":_to_bool
+}
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """Return the numpy module, or None if NumPy is not installed.
+    
+    It is imported on first use rather than with this module, which the config check also loads."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def reduce_block(samples):
+    """Return the mean, min, max and population standard deviation of a block of samples as a dictionary.
+    
+    Uses NumPy if it is installed. An empty block gives None for each statistic."""
+    np = _numpy()
+    if np is not None:
+        samples = np.asarray(samples, dtype=float)
+        if samples.size == 0:
+            return {"mean":None, "min":None, "max":None, "std":None}
+        return {"mean":float(samples.mean()), "min":float(samples.min()),
+                "max":float(samples.max()), "std":float(samples.std())}
+    samples = [float(v) for v in samples]
+    if not samples:
+        return {"mean":None, "min":None, "max":None, "std":None}
+    mean = sum(samples)/len(samples)
+    return {"mean":mean, "min":min(samples), "max":max(samples),
+            "std":math.sqrt(sum((v - mean)**2 for v in samples)/len(samples))}
+
+
+class UnresolvedKeyError(AttributeError):
+    """A logged_data entry could not be resolved to a hardware attribute or function."""
+
+
+def _raise_attribute_error(message):
+    """Stand-in accessor for a logged_data entry that could not be resolved."""
+    raise UnresolvedKeyError(message)
+
+
+def control_target_error(hardware, target, function):
+    """Return why target can't be set (or called, if function is True) on hardware, or None if it can.
+    
+    hardware may be the hardware class, to check a target without connecting."""
+    try:
+        if isinstance(hardware, HardwareProxy):
+            # The hardware is in a worker process, so ask it what the attribute is
+            is_method = hardware.has_method(target)
+        else:
+            is_method = isinstance(inspect.getattr_static(hardware, target), (types.FunctionType, types.MethodType))
+    except AttributeError:
+        return f"{target} is not an attribute of the hardware"
+    if function and not is_method:
+        return f"{target} is not a function of the hardware"
+    if not function and is_method:
+        return f"{target} is a function of the hardware, not an attribute"
+    return None
+
+
+def logged_data_target_error(key, entry):
+    """Return why a flattened logged_data entry can't be resolved, or None if it can.
+    
+    Only the first part of a dotted attribute is checked, against the interface and hardware classes,
+    as the rest depends on the values read from the connected hardware."""
+    entry = entry or {}
+    attribute = entry.get("attribute", entry.get("function", key.replace(":", ".")))
+    name = attribute.split(".")[0]
+    for cls in (ExampleHardwareInterface, ExampleHardware):
+        try:
+            inspect.getattr_static(cls, name)
+            return None
+        except AttributeError:
+            pass
+    return f"{name} is not an attribute of the hardware"
+
+
+class LoggedPoint:
+    """A precompiled accessor for a single logged_data entry.
+    
+    `read` is a zero argument callable - either a getter bound to the object that
+    owns the attribute, or a bound method with its arguments already applied.
+    
+    `lock` is the lock held while reading the point in concurrent read mode, and
+    `timeout` is the time in seconds to wait for the read, or None for the default.
+    
+    `block` is None for scalar points. For block points, which read an array of samples,
+    it is True if the raw samples are logged along with their statistics, otherwise False.
+    
+    `last_read` is the (start, duration) of the last successful read in perf_counter_ns()
+    nanoseconds, or None if the point has not been read."""
+    __slots__ = ("key", "read", "lock", "timeout", "block", "last_read")
+    
+    def __init__(self, key, read, lock=None, timeout=None, block=None):
+        self.key = key
+        self.read = read
+        self.lock = lock
+        self.timeout = timeout
+        self.block = block
+        self.last_read = None
+        
+    def store_block(self, logged_data, reading):
+        """Add a block reading to logged_data as key:mean, key:min, key:max, key:std and optionally key:raw"""
+        key = self.key
+        for name, value in reduce_block(reading).items():
+            logged_data[f"{key}:{name}"] = value
+        if self.block:
+            logged_data[f"{key}:raw"] = reading
+        
+    def locked_read(self, metrics):
+        """Read the point while holding its lock, recording the lock wait and read times in metrics"""
+        start = perf_counter_ns()
+        with self.lock:
+            acquired = perf_counter_ns()
+            reading = self.read()
+        elapsed = perf_counter_ns() - acquired
+        metrics.phase("lock_wait", acquired - start)
+        metrics.key(self.key, elapsed)
+        self.last_read = (acquired, elapsed)
+        return reading
+        
+    def __repr__(self):
+        return f"LoggedPoint({self.key!r}, {self.read!r})"
+
+
 class ExampleHardwareInterface:
     """An example daemon interface for communicating with a piece of hardware."""
-    def __init__(self, config=None, logger=None):
+    def __init__(self, config=None, logger=None, name=None):
         """Create a new daemon class that carries out monitoring and control of a simulated
         piece of hardware. 
         
         Pass the initial config to the hardware object if given.
         
         Keyword Arguments:
-            config (dict) : dictionary of config values for the hardware and daemon"""
+            config (dict) : dictionary of config values for the hardware and daemon
+            logger (logging.Logger) : the daemon's logger.
+            name (str) : the name of the device, such as its smax_key, to tell its log messages and threads apart"""
+        self.name = name
         self._hardware = None
         self._hardware_config = None
         self._hardware_lock = threading.Lock()
         self._hardware_error = 'No connection attempted'
         self._hardware_data = {}
+        self._logging_plan = []
+        self._plan_index = {}
+        # Keys of the plan that resolved to the hardware, and those of them that have failed in every
+        # sweep since the last sweep in which a key was read. The connection is treated as lost once
+        # every resolved key has failed.
+        self._resolved_keys = set()
+        self._failing_keys = set()
+        self._logging_interval = None
+        self._logging_intervals = {}
+        # time.time() - perf_counter_ns()*1e-9 at the start of the last sweep, to convert read times to wall clock times
+        self._clock_offset = 0.0
+        
+        # Publish policies for each logged key, and the last published [value, time] of each key
+        self._publish_policy = PublishPolicy()
+        self._publish_policies = {}
+        self._published = {}
+        
+        # History of recent readings, as (point key, SampleHistory) keyed by logged data key,
+        # and the number of samples to keep for values without their own "history"
+        self._history = {}
+        self._history_samples = 0
+        self._history_lock = threading.Lock()
+        
+        # Adaptive load shedding. Values with a low "priority" are skipped, and then the logging
+        # intervals backed off, while cycles overrun their budget.
+        self._load_shedding = False
+        self._load_shedder = LoadShedder(logger=logger, name=name or "Load shedding")
+        self._priorities = {}
+        self._effective_rate = 0.0
+        
+        # Rolling timings of hardware reads
+        self.metrics = TimingMetrics()
+        
+        # Cache of hardware attribute reads
+        self._read_cache = ReadCache()
+        self._use_read_cache = True
+        
+        # Settings for hosting the hardware object in a worker process
+        self._hardware_process = False
+        self._hardware_process_timeout = 10
+        self._hardware_process_start_method = "spawn"
+        
+        # Queue of writes from the control callbacks, applied to the hardware by a worker thread
+        self._commands = CommandQueue(self._apply_commands, logger=logger, metrics=self.metrics,
+                                      name=f"HardwareCommands {name}" if name else "HardwareCommands")
+        # Names of functions called by declarative control keys, rather than attributes set by configure
+        self._control_functions = set()
+        
+        # Concurrent read settings. If _read_workers is 0, points are read in series.
+        self._read_workers = 0
+        self._read_lock_scope = "device"
+        self._read_timeout = None
+        self._read_executor = None
         
         self.logger = logger
         
+        # The state of the hardware connection. When it is lost, it is reconnected in the background.
+        self.link = Link(f"{name} hardware" if name else "Hardware", self.connect_hardware, logger=logger)
+        
         if config:
             self.configure(config)
             
-        self.connect_hardware()
+        try:
+            self.connect_hardware()
+            self.link.connected()
+        except Exception as e:
+            self.link.lost(repr(e))
         
     def __getattr__(self, name):
         """Override __getattr__ so that we can pass requests for attributes to the
@@ -66,149 +302,695 @@ class ExampleHardwareInterface:
         try:
             return self.__getattribute__(name)
         except AttributeError:
-            return self._hardware.__getattribute__(name)
+            return getattr(self._hardware, name)
             
     def configure(self, config):
-        """Configure the daemon and hardware"""
+        """Configure the daemon and hardware.
+        
+        config need only contain the settings to change. Only the hardware config values
+        that differ from the current ones are sent to connected hardware. logged_data must
+        already be flattened, as it is by config_compiler.compile_config()."""
         
+        hardware_changes = {}
         if 'config' in config.keys():
+            old = self._hardware_config or {}
             self._hardware_config = config['config']
+            hardware_changes = {k:v for k, v in (self._hardware_config or {}).items() if k not in old or old[k] != v}
+            
+        if 'logging_interval' in config.keys():
+            self._logging_interval = config['logging_interval']
+            
+        if 'concurrent_reads' in config.keys():
+            concurrent_reads = config['concurrent_reads']
+            self._read_workers = concurrent_reads.get('max_workers', 0)
+            self._read_lock_scope = concurrent_reads.get('lock_scope', 'device')
+            self._read_timeout = concurrent_reads.get('timeout', None)
+            if self._read_lock_scope not in ('device', 'channel', 'point'):
+                raise ValueError(f"Unknown concurrent_reads lock_scope {self._read_lock_scope}")
+            self._shutdown_read_executor()
+            # Locks are assigned when the plan is compiled
+            if self._hardware_data and 'logged_data' not in config.keys():
+                self.compile_logging_plan()
+            
+        if 'logged_data' in config.keys():
+            self._hardware_data = dict(config['logged_data'])
+            self.compile_logging_plan()
+            
+        if 'publish_policy' in config.keys():
+            self._publish_policy = PublishPolicy.from_config(config['publish_policy'])
+            
+        if 'publish_policy' in config.keys() or 'logged_data' in config.keys():
+            self._publish_policies = {}
+            for key, entry in self._hardware_data.items():
+                policy = PublishPolicy.from_config(entry, self._publish_policy)
+                self._publish_policies[key] = policy
+                if entry and "samples" in entry:
+                    # Block reads are published as their statistics and raw samples
+                    for name in ("mean", "min", "max", "std", "raw"):
+                        self._publish_policies[f"{key}:{name}"] = policy
+            self._published = {}
+            
+        if 'logging_interval' in config.keys() or 'logged_data' in config.keys():
+            self._logging_intervals = {}
+            for key, entry in self._hardware_data.items():
+                if entry and "interval" in entry:
+                    self._logging_intervals[key] = entry["interval"]
+                else:
+                    self._logging_intervals[key] = self._logging_interval
+            
+        if 'load_shedding' in config.keys():
+            load_shedding = config['load_shedding']
+            self._load_shedding = load_shedding.get('enabled', True)
+            self._load_shedder.budget = load_shedding.get('budget', 0.8)
+            self._load_shedder.max_backoff = load_shedding.get('max_backoff', 8)
+            self._load_shedder.recover_cycles = load_shedding.get('recover_cycles', 10)
+            if not self._load_shedding:
+                self._load_shedder.backoff = 1
+                self._load_shedder.shed = 0
             
         if 'logged_data' in config.keys():
-            self._hardware_data = flatten_logged_data(config['logged_data'])
+            self._priorities = {key:(entry or {}).get("priority", 0) for key, entry in self._hardware_data.items()}
+            self._load_shedder.set_priorities(self._priorities.values())
+            
+        if 'load_shedding' in config.keys() or 'logged_data' in config.keys() or 'logging_interval' in config.keys():
+            self._update_effective_rate()
+            
+        if 'history' in config.keys():
+            self._history_samples = config['history'].get('samples', 0)
             
-        if self._hardware and self._hardware_config:
+        if 'history' in config.keys() or 'logged_data' in config.keys():
+            self._configure_history()
+            
+        if 'hardware_process' in config.keys():
+            hardware_process = config['hardware_process']
+            self._hardware_process = hardware_process.get('enabled', True)
+            self._hardware_process_timeout = hardware_process.get('timeout', 10)
+            self._hardware_process_start_method = hardware_process.get('start_method', 'spawn')
+            
+        if 'hardware_cache' in config.keys():
+            self._use_read_cache = config['hardware_cache'].get('enabled', True)
+            self._read_cache.ttl = config['hardware_cache'].get('ttl', 0)
+            if self._hardware_data and 'logged_data' not in config.keys():
+                self.compile_logging_plan()
+            
+        if self._hardware and hardware_changes:
             with self._hardware_lock:
                 try:   
-                    self._hardware.configure(self._hardware_config)
+                    self._hardware.configure(hardware_changes)
                 except AttributeError:
                     pass
+                self._read_cache.invalidate(hardware_changes.keys())
+                    
+    def _configure_history(self):
+        """Create the history buffers for the logged data, keeping the existing history of values whose size is unchanged.
+        
+        Block reads keep the history of their statistics, but not of their raw samples."""
+        history = {}
+        for key, entry in self._hardware_data.items():
+            entry = entry or {}
+            size = entry.get("history", self._history_samples)
+            if not size:
+                continue
+            names = [f"{key}:{name}" for name in ("mean", "min", "max", "std")] if "samples" in entry else [key]
+            for name in names:
+                old = self._history.get(name)
+                history[name] = (key, old[1] if old is not None and old[1].size == size else SampleHistory(size))
+        with self._history_lock:
+            self._history = history
+            
+    def _record_history(self, logged_data):
+        """Add the readings in logged_data to their histories, timestamped with the time each read started"""
+        offset = self._clock_offset
+        index = self._plan_index
+        histories = self._history
+        with self._history_lock:
+            # Only the keys read in this sweep are visited, however many keys keep a history
+            for key, value in logged_data.items():
+                entry = histories.get(key)
+                if entry is None or value is None:
+                    continue
+                point_key, history = entry
+                try:
+                    history.append(offset + index[point_key].last_read[0]*1e-9, value)
+                except TypeError:
+                    # Only numbers are kept
+                    pass
+                    
+    def history(self, key, start=None, end=None, bins=None):
+        """Return the recent history of a logged value.
+        
+        Arguments:
+            key (str) : the logged data key.
+        
+        Keyword Arguments:
+            start (float) : the start of the window as a wall clock time in seconds since the epoch, or if
+                negative, in seconds before now. None for the oldest sample.
+            end (float) : the end of the window, as for start. None for the newest sample.
+            bins (int) : if given, downsample the window into this many bins of equal duration.
+        
+        Returns:
+            dict : the "key", with lists of the "time" and "value" of each sample, or if bins is given,
+                the start "time", "mean", "min", "max" and "count" of each bin that has samples.
+        
+        Raises:
+            KeyError : if the history of key is not kept."""
+        now = time.time()
+        if start is not None and start < 0:
+            start += now
+        if end is not None and end < 0:
+            end += now
+        with self._history_lock:
+            try:
+                history = self._history[key][1]
+            except KeyError:
+                raise KeyError(f"No history kept for {key}") from None
+            if bins:
+                result = history.aggregate(bins, start, end)
+            else:
+                times, values = history.window(start, end)
+                result = {"time":times.tolist(), "value":values.tolist()}
+        result["key"] = key
+        return result
+        
+    def read_hardware(self, name):
+        """Read the hardware attribute name through the read cache.
+        
+        Use this for hardware attributes in derived values, so that attributes used by several
+        logged values are only read once per sweep."""
+        if self._use_read_cache:
+            return self._read_cache.get(self._hardware, name)
+        return getattr(self._hardware, name)
+        
+    @property
+    def cache_hits(self):
+        """The number of hardware attribute reads answered from the read cache"""
+        return self._read_cache.hits
+    
+    @property
+    def cache_misses(self):
+        """The number of hardware attribute reads that went to the hardware"""
+        return self._read_cache.misses
+                    
+    def compile_logging_plan(self):
+        """Resolve the flattened logged_data into a list of LoggedPoint accessors.
+        
+        This does the attribute lookup, compound key walking and method detection once,
+        so that logging_action only has to call each accessor. It must be rerun whenever
+        the logged_data config or the hardware object changes."""
+        plan = []
+        channel_locks = {}
+        if self._hardware is not None:
+            for key, entry in self._hardware_data.items():
+                entry = entry or {}
+                # Assign the lock held while reading this point in concurrent read mode.
+                # Points with the same channel share a lock, and by default each point
+                # is its own channel.
+                if self._read_lock_scope == 'device':
+                    lock = self._hardware_lock
+                elif self._read_lock_scope == 'channel':
+                    lock = channel_locks.setdefault(entry.get('channel', key), threading.Lock())
+                else:
+                    lock = threading.Lock()
+                block = entry.get('raw', False) if 'samples' in entry else None
+                plan.append(LoggedPoint(key, self._compile_accessor(key, entry), lock=lock, timeout=entry.get('timeout', None), block=block))
+        self._logging_plan = plan
+        self._plan_index = {point.key: point for point in plan}
+        self._resolved_keys = {point.key for point in plan
+                               if not (isinstance(point.read, partial) and point.read.func is _raise_attribute_error)}
+        self._failing_keys = set()
+        
+    def publish_filter(self, logged_data, now):
+        """Return the items of logged_data that should be published under each key's publish policy.
+        
+        Keys without their own policy, such as comm_status, use the default publish_policy.
+        
+        Arguments:
+            logged_data (dict) : the readings returned by logging_action
+            now (float) : the current monotonic time in seconds"""
+        published = self._published
+        policies = self._publish_policies
+        default = self._publish_policy
+        return {k:v for k, v in logged_data.items() if policies.get(k, default).should_publish(v, published.get(k), now)}
+        
+    def mark_published(self, logged_data, now):
+        """Record that the items of logged_data were published to SMA-X at time now"""
+        published = self._published
+        for k, v in logged_data.items():
+            published[k] = (v, now)
+        
+    def logging_budget(self, keys=None):
+        """Return the time budget in seconds for reading keys, which is the shortest of their logging intervals.
+        
+        Keyword Arguments:
+            keys (list) : the logged data keys. If None, all the logged data."""
+        intervals = self._logging_intervals
+        if keys is None:
+            budget = min(intervals.values(), default=None)
+        else:
+            budget = min((intervals[k] for k in keys if k in intervals), default=None)
+        if budget is None:
+            return None
+        return budget*self._load_shedder.backoff
+        
+    def logging_groups(self):
+        """Return the logged data keys grouped by their logging interval.
+        
+        Keys without their own "interval" in logged_data use the daemon's logging_interval.
+        While load shedding has backed off, the intervals are multiplied by the backoff.
+        
+        Returns:
+            dict : lists of keys, keyed by logging interval in seconds."""
+        backoff = self._load_shedder.backoff
+        groups = {}
+        for key, interval in self._logging_intervals.items():
+            groups.setdefault(interval*backoff, []).append(key)
+        return groups
+        
+    def adapt_load(self, elapsed, keys=None):
+        """Shed low priority values, or back off the logging intervals, if a cycle overran its budget,
+        and recover once cycles are well inside it. Does nothing unless load_shedding is enabled.
+        
+        Arguments:
+            elapsed (float) : the time in seconds the cycle that read keys took.
+        
+        Keyword Arguments:
+            keys (list) : the logged data keys read in the cycle. If None, all the logged data.
+        
+        Returns:
+            bool : True if the logging intervals changed, so logging_groups() must be rescheduled."""
+        if not self._load_shedding:
+            return False
+        intervals = self._logging_intervals
+        if keys is None:
+            interval = min(intervals.values(), default=None)
+        else:
+            interval = min((intervals[k] for k in keys if k in intervals), default=None)
+        if interval is None:
+            return False
+        shedder = self._load_shedder
+        state = (shedder.backoff, shedder.shed)
+        changed = shedder.update(elapsed, interval)
+        if (shedder.backoff, shedder.shed) != state:
+            self._update_effective_rate()
+        return changed
+        
+    def _update_effective_rate(self):
+        """Recalculate the number of values read per second, allowing for shedding and backoff"""
+        shedder = self._load_shedder
+        min_priority = shedder.min_priority if self._load_shedding else None
+        rate = 0.0
+        for key, interval in self._logging_intervals.items():
+            if interval and (min_priority is None or self._priorities.get(key, 0) >= min_priority):
+                rate += 1/interval
+        self._effective_rate = rate/shedder.backoff
+        
+    def _compile_accessor(self, key, entry):
+        """Build the read callable for a single flattened logged_data entry.
+        
+        entry must be a dictionary - None entries are passed in as {}."""
+        if "attribute" in entry:
+            attribute = entry["attribute"]
+        elif "function" in entry:
+            attribute = entry["function"]
+        else:
+            attribute = key.replace(":", ".")
+            
+        path = attribute.split(".")
+        
+        # Attributes implemented by this interface take precedence over the hardware,
+        # matching the lookup order of __getattr__
+        try:
+            inspect.getattr_static(self, path[0])
+            root = self
+        except AttributeError:
+            root = self._hardware
+            
+        try:
+            parent = root
+            for d in path[:-1]:
+                parent = getattr(parent, d)
+            if isinstance(parent, HardwareProxy):
+                # The hardware is in a worker process, so ask it what the attribute is
+                is_method = parent.has_method(path[-1])
+            else:
+                leaf = inspect.getattr_static(parent, path[-1])
+                is_method = isinstance(leaf, (types.FunctionType, types.MethodType))
+        except AttributeError as e:
+            if self.logger:
+                self.logger.error(f"Could not resolve logged_data key {key} to {attribute}: {e}")
+            return partial(_raise_attribute_error, f"{key}: {e}")
+        
+        # If this is a method, bind it and its arguments now
+        if is_method:
+            method = getattr(parent, path[-1])
+            args = entry.get("args", [])
+            if type(args) is not list:
+                args = [args]
+            # Block reads are passed the number of samples to read as their last argument
+            if "samples" in entry.keys():
+                args = args + [entry["samples"]]
+            if args:
+                return partial(method, *args)
+            return method
+        
+        # Plain hardware attributes are read through the cache
+        if root is self._hardware and len(path) == 1 and self._use_read_cache and entry.get("cache", True):
+            return partial(self._read_cache.get, root, attribute)
+        return partial(attrgetter(attribute), root)
 
     def connect_hardware(self):
-        """Create and initialize hardware communication object."""
+        """Create and initialize hardware communication object.
+        
+        Raises the exception from the hardware if the connection fails."""
         try:
             with self._hardware_lock:
-                self._hardware = ExampleHardware(config=self._hardware_config)
+                self._close_hardware()
+                if self._hardware_process:
+                    self._hardware = HardwareProxy(ExampleHardware, config=self._hardware_config,
+                                                   timeout=self._hardware_process_timeout,
+                                                   start_method=self._hardware_process_start_method,
+                                                   logger=self.logger)
+                else:
+                    self._hardware = ExampleHardware(config=self._hardware_config)
                 self._hardware_error = "None"
                 if self._hardware and self._hardware_config:
                     try:   
                         self._hardware.configure(self._hardware_config)
                     except AttributeError:
                         pass
+                self._read_cache.invalidate()
+            # The logging plan binds to the hardware object, so rebuild it for the new connection
+            self.compile_logging_plan()
                 
         except Exception as e: # Hardware connection errors
-            self._hardware = None
+            self._close_hardware()
             self._hardware_error = repr(e)
             self.logger.error(f"Failed to connect to hardware with error {e}.")
+            raise
             
-    def disconnect_hardware(self):
+    def _close_hardware(self):
+        """Drop the hardware object and the logging plan bound to it, stopping its worker process if it has one"""
+        hardware = self._hardware
         self._hardware = None
+        self._logging_plan = []
+        self._plan_index = {}
+        if isinstance(hardware, HardwareProxy):
+            hardware.close()
+            
+    def disconnect_hardware(self):
+        """Disconnect from the hardware. It is reconnected in the background by the next logging_action."""
+        self.link.close()
+        self._close_hardware()
         self._hardware_error = "disconnected"
+        self._shutdown_read_executor()
         
+    def close(self):
+        """Disconnect from the hardware for good, and stop the command queue worker.
+        Writes to the control keys are dropped afterwards."""
+        self.disconnect_hardware()
+        self._commands.close(timeout=self._hardware_process_timeout)
         
-    def logging_action(self):
-        """Get logging data from hardware and share to SMA-X"""
-        # check for hardware connection, and connect if not present
-        # This will automatically retry the connection every logging_interval
-        # We could instead set up a connection retrying loop, but this
-        # seems like it would work for most things, and will provide
-        # feedback to the 
-        if self._hardware is None:
-            self.connect_hardware()
+    def _shutdown_read_executor(self):
+        """Stop the concurrent read worker threads, without waiting for reads in progress"""
+        if self._read_executor is not None:
+            self._read_executor.shutdown(wait=False)
+            self._read_executor = None
+        
+    def _read_concurrently(self, points):
+        """Read points in parallel on the read thread pool, holding each point's lock.
         
-        if self._hardware:
+        All the reads are submitted at once, and then collected in order, each waiting until
+        its own timeout after the start of the sweep.
+        
+        Returns:
+            (dict, dict) : the readings keyed by logged data key, and the errors of the keys that failed or timed out."""
+        if self._read_executor is None:
+            self._read_executor = ThreadPoolExecutor(max_workers=self._read_workers, thread_name_prefix='HardwareRead')
+            
+        log_info = self.logger.isEnabledFor(logging.INFO)
+        start = time.monotonic()
+        futures = [(point, self._read_executor.submit(point.locked_read, self.metrics)) for point in points]
+        logged_data = {}
+        failed = {}
+        for point, future in futures:
+            timeout = point.timeout if point.timeout is not None else self._read_timeout
             try:
+                if timeout is None:
+                    reading = future.result()
+                else:
+                    reading = future.result(timeout=max(start + timeout - time.monotonic(), 0))
+            except FuturesTimeoutError:
+                future.cancel()
+                failed[point.key] = "timeout"
+                self.logger.warning('Timed out reading hardware %s', point.key)
+                continue
+            except Exception as e:
+                failed[point.key] = e
+                continue
+            if point.block is None:
+                logged_data[point.key] = reading
+            else:
+                point.store_block(logged_data, reading)
+            if log_info:
+                self.logger.info('Got data for hardware %s: %s', point.key, reading)
+        return logged_data, failed
+        
+    def logging_action(self, keys=None):
+        """Read the logged data from the hardware.
+        
+        Never waits for the hardware to reconnect. If the connection has been lost, only comm_status
+        and comm_error are returned while the link reconnects in the background. A key that fails to
+        read is left out of the readings, and listed in comm_bad_keys, while the other keys are read
+        as normal. The connection is only treated as lost if a read raises ConnectionError, or every
+        key that resolved to the hardware has failed, over as many sweeps as it takes to read them all,
+        without any key being read in between. Keys that could not be resolved never count.
+        
+        Keyword Arguments:
+            keys (list) : the logged data keys to read. If None, read all the logged data."""
+        link = self.link
+        if self._hardware is None or link.state == Link.RECONNECTING:
+            if link.state != Link.RECONNECTING:
+                # Disconnected by disconnect_hardware(), so start reconnecting
+                link.lost(self._hardware_error)
+            return {'comm_status':Link.RECONNECTING,
+                    'comm_error':str(link.error)}
+        
+        metrics = self.metrics
+        sweep_start = perf_counter_ns()
+        self._clock_offset = time.time() - sweep_start*1e-9
+        self._read_cache.new_sweep()
+        points = []
+        try:
+            if keys is None:
+                points = self._logging_plan
+            else:
+                points = [self._plan_index[k] for k in keys if k in self._plan_index]
+            if self._load_shedding and self._load_shedder.shed:
+                min_priority = self._load_shedder.min_priority
+                priorities = self._priorities
+                read = [point for point in points if priorities.get(point.key, 0) >= min_priority]
+                self._load_shedder.shed_count += len(points) - len(read)
+                points = read
+                
+            if self._read_workers:
+                logged_data, failed = self._read_concurrently(points)
+            else:
+                failed = {}
+                # Check the log level once per sweep, so that disabled messages cost nothing per key
+                log_debug = self.logger.isEnabledFor(logging.DEBUG)
+                log_info = self.logger.isEnabledFor(logging.INFO)
                 with self._hardware_lock:
+                    metrics.phase("lock_wait", perf_counter_ns() - sweep_start)
                     logged_data = {}
-                    # do logging gets
-                    for data in self._hardware_data.keys():
-                        self.logger.debug(f"attempting to get key {data}")
-                        # Check this first, or later tests throw exceptions
-                        if self._hardware_data[data] is None:
-                            attribute = data.replace(":", ".")
-                        elif "attribute" in self._hardware_data[data]:
-                            attribute = self._hardware_data[data]["attribute"]
-                        elif "function" in self._hardware_data[data]:
-                            attribute = self._hardware_data[data]["function"]
+                    # do logging gets from the precompiled plan
+                    for point in points:
+                        if log_debug:
+                            self.logger.debug("attempting to get key %s", point.key)
+                        start = perf_counter_ns()
+                        try:
+                            reading = point.read()
+                        except Exception as e:
+                            failed[point.key] = e
+                            continue
+                        elapsed = perf_counter_ns() - start
+                        metrics.key(point.key, elapsed)
+                        point.last_read = (start, elapsed)
+                        if point.block is None:
+                            logged_data[point.key] = reading
                         else:
-                            attribute = data.replace(":", ".")
-                        self.logger.debug(f"attempting to get data {attribute}")
-                        reading = self.__getattr__(attribute.split(".")[0])
-                        # If this is a compound key, push down to the leaf attribute
-                        if len(attribute.split(".")) > 1:
-                            for d in attribute.split(".")[1:]:
-                                reading = reading.__getattribute__(d)
-                        # If this is a method, call it to get the value
-                        if type(reading) is types.MethodType:
-                            if "args" in self._hardware_data[data].keys():
-                                args = self._hardware_data[data]["args"]
-                                if type(args) is not list:
-                                    args = [args]
-                                self.logger.debug(f"calling {reading} with arguments {args}.")
-                                reading = reading(*args)
-                            else:
-                                self.logger.debug(f"calling {reading}")
-                                reading = reading()
-                        logged_data[data] = reading
-                        self.logger.info(f'Got data for hardware {data}: {reading}')
-                logged_data['comm_status'] = "good"
-                logged_data['comm_error'] = "None"
-            except Exception as e: # Except hardware connection errors
-                self._hardware = None
-                self.logger.debug(f'HardwareInterface.logging_action: connection error {e}')
-                logged_data = {'comm_status':'connection error'}
-                logged_data['comm_error'] = repr(e)
+                            point.store_block(logged_data, reading)
+                        if log_info:
+                            self.logger.info('Got data for hardware %s: %s', point.key, reading)
+        except Exception as e: # Errors outside the reads of individual keys fail the whole sweep
+            failed = {point.key:e for point in points} or {"hardware":e}
+            logged_data = {}
+            
+        if failed:
+            first = next(iter(failed.values()))
+            error = f"Failed reading {', '.join(failed)}: {first!r}"
+            if len(failed) < len(points):
+                self._failing_keys.clear()
+            else:
+                self._failing_keys.update(k for k in failed if k in self._resolved_keys)
+            if any(isinstance(e, ConnectionError) for e in failed.values()) \
+                    or (self._failing_keys and self._failing_keys >= self._resolved_keys):
+                self._failing_keys.clear()
+                self.logger.debug('HardwareInterface.logging_action: connection error %s', first)
+                self._hardware_error = repr(first)
+                self._close_hardware()
+                link.lost(error)
+                return {'comm_status':Link.RECONNECTING,
+                        'comm_error':error}
+            link.degraded(error)
+            logged_data['comm_status'] = Link.DEGRADED
+            logged_data['comm_error'] = error
+            logged_data['comm_bad_keys'] = ", ".join(failed)
         else:
-            logged_data = {'comm_status':"connection error",
-                           'comm_error':"Not Connected"}
-        
+            self._failing_keys.clear()
+            if link.state != Link.CONNECTED:
+                link.connected()
+            logged_data['comm_status'] = "good"
+            logged_data['comm_error'] = "None"
+            logged_data['comm_bad_keys'] = ""
+        logged_data['command_queue_depth'] = self._commands.depth
+        if self._load_shedding:
+            logged_data['effective_rate'] = self._effective_rate
+            logged_data['shed_count'] = self._load_shedder.shed_count
+        if self._history:
+            self._record_history(logged_data)
+        metrics.phase("hardware_read", perf_counter_ns() - sweep_start)
+        metrics.counters.update(cache_hits=self._read_cache.hits, cache_misses=self._read_cache.misses,
+                                commands_applied=self._commands.applied, commands_coalesced=self._commands.coalesced,
+                                hardware_link_losses=link.losses, shed_count=self._load_shedder.shed_count)
         return logged_data
     
+    def sample_times(self, keys):
+        """Return the acquisition time and read duration of the last readings of keys.
+        
+        Arguments:
+            keys (iterable) : logged data keys returned by logging_action(). The statistics of a
+                block point share the times of the block. Keys that are not hardware readings are skipped.
+        
+        Returns:
+            dict : (acquired, read_time) tuples keyed by logged data key, where acquired is the wall clock
+                time in seconds since the epoch that the read started, and read_time is its duration in seconds."""
+        offset = self._clock_offset
+        times = {}
+        for k in keys:
+            point = self._plan_index.get(k)
+            if point is None:
+                point = self._plan_index.get(k.rpartition(":")[0])
+                if point is None or point.block is None:
+                    continue
+            if point.last_read is not None:
+                start, elapsed = point.last_read
+                times[k] = (offset + start*1e-9, elapsed*1e-9)
+        return times
+    
     @property
     def random_base_minus_one(self):
         """Get the random base and return a value 1 lower"""
-        return self._hardware.random_base - 1
+        return self.read_hardware("random_base") - 1
 
     def random_range_plus_one(self):
         """Get the random range and return a value 1 higher"""
-        return self._hardware.random_range + 1
+        return self.read_hardware("random_range") + 1
         
-    def set_random_base_callback(self, message):
-        """Callback to be triggered on Pub/Sub for random base value"""
-        if self.logger:
-            date = message.timestamp
-            self.logger.info(f'Received callback notification for {message.smaxname} from {message.origin} with data {message.data} at {date}')
+    def control_callback(self, control_key, binding):
+        """Return the Pub/Sub callback for a control key.
+        
+        Arguments:
+            control_key (str) : the name of the control key, used in log messages.
+            binding (str or dict) : either the name of a callback method of this class, or a dictionary
+                declaring the target of the control key:
+                    "attribute" or "function" : the hardware attribute to set, or the function to call with the value.
+                    "type" : "float", "int", "str" or "bool" - the type to convert the value to.
+                    "min", "max" : the allowed range of the value.
+                    "rate_limit" : the maximum number of writes per second. Writes in between are coalesced.
+                    
+        Values from declarative control keys are checked on the Pub/Sub thread, then applied through the
+        command queue. If the target is not an attribute or function of the connected hardware, the error is
+        logged and every write to the control key is rejected. The target is checked against the hardware class
+        if the hardware is not connected yet."""
+        if isinstance(binding, str):
+            return getattr(self, binding)
         
-        newbase = message.data
+        if "attribute" in binding:
+            target = binding["attribute"]
+        elif "function" in binding:
+            target = binding["function"]
+        else:
+            raise ValueError(f"Control key {control_key} must give an attribute or function")
+        error = self._check_control_target(target, "function" in binding)
+        if error:
+            if self.logger:
+                self.logger.error(f"Could not resolve control key {control_key} to {target}: {error}")
+        elif "function" in binding:
+            self._control_functions.add(target)
+        coerce = control_types[binding["type"]] if "type" in binding else None
+        minimum = binding.get("min", None)
+        maximum = binding.get("max", None)
+        self._commands.set_rate_limit(target, binding.get("rate_limit", None))
         
-        if self._hardware:
+        def callback(message):
+            if self.logger:
+                self.logger.info('Received callback notification for %s from %s with data %s at %s', message.smaxname, message.origin, message.data, message.timestamp)
+            value = message.data
             try:
-                with self._hardware_lock:
-                    self._hardware.random_base = newbase
-            except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
+                if error:
+                    raise ValueError(error)
+                if coerce:
+                    value = coerce(value)
+                if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+                    raise ValueError(f"{value} is outside the range {minimum} to {maximum}")
+            except (TypeError, ValueError) as e:
                 if self.logger:
-                    self.logger.error(f'Attempt by {message.origin} to set random_base to {newbase} failed with {self._hardware_error}')
-                
+                    self.logger.error(f'Attempt by {message.origin} to set {target} via {control_key} to {message.data} rejected: {e}')
+                return
+            self._commands.put(target, value, message.origin)
+        callback.__name__ = f"{control_key}_callback"
+        return callback
+        
+    def _check_control_target(self, target, function):
+        """Return why target can't be set (or called, if function is True) on the hardware, or None if it can.
+        
+        If the hardware is not connected, target is checked against the hardware class."""
+        hardware = self._hardware
+        return control_target_error(ExampleHardware if hardware is None else hardware, target, function)
+        
+    def _apply_commands(self, config):
+        """Apply the merged writes from the command queue to the hardware, setting attributes in one
+        configure call and then calling any control functions"""
+        if self._hardware is None:
+            raise RuntimeError("Hardware not connected")
+        functions = {k:v for k, v in config.items() if k in self._control_functions}
+        attributes = {k:v for k, v in config.items() if k not in self._control_functions}
+        try:
+            with self._hardware_lock:
+                if attributes:
+                    self._hardware.configure(attributes)
+                    self._read_cache.invalidate(attributes.keys())
+                for name, value in functions.items():
+                    getattr(self._hardware, name)(value)
+                if functions:
+                    # A function could change any attribute
+                    self._read_cache.invalidate()
+        except Exception as e: # Except hardware errors
+            self._hardware_error = repr(e)
+            raise
+        
+    def set_random_base_callback(self, message):
+        """Callback to be triggered on Pub/Sub for random base value"""
         if self.logger:
-            self.logger.status(f'{message.origin} set random_range to {newbase}')
+            date = message.timestamp
+            self.logger.info('Received callback notification for %s from %s with data %s at %s', message.smaxname, message.origin, message.data, date)
+        
+        self._commands.put("random_base", message.data, message.origin)
             
     def set_random_range_callback(self, message):
-        """Callback to be triggered on Pub/Sub for random base value"""
+        """Callback to be triggered on Pub/Sub for random range value"""
         if self.logger:
             date = message.timestamp
-            self.logger.info(f'Received callback notification for {message.smaxname} from {message.origin} with data {message.data} at {date}')
+            self.logger.info('Received callback notification for %s from %s with data %s at %s', message.smaxname, message.origin, message.data, date)
         
-        newrange = message.data
-        
-        if self._hardware:
-            try:
-                with self._hardware_lock:
-                    self._hardware.random_range = newrange
-            except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
-                if self.logger:
-                    self.logger.error(f'Attempt by {message.origin} to set random_range to {newrange} failed with {self._hardware_error}')
-                
-        if self.logger:
-            self.logger.status(f'{message.origin} set random_range to {newrange}')
\ No newline at end of file
+        self._commands.put("random_range", message.data, message.origin)
@@ -1,27 +1,44 @@
 #!/usr/bin/env python
+from time import perf_counter
+_import_start = perf_counter()
+
+import argparse
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 import os
 import time
+from time import perf_counter_ns
 
 import threading
-import json
-
-from retrying import retry
-import systemd.daemon
+from functools import partial
 import signal
 
+# asyncio, retrying and systemd are imported where they are used, to keep startup fast
+
 # Change these based on system setup
 default_smax_config = os.path.expanduser("~smauser/wsma_config/smax_config.json")
 default_config = os.path.expanduser("~smauser/wsma_config/example_smax_daemon/daemon_config.json")
+# The compiled config cache is written next to the log file
+default_config_cache = "example_smax_daemon_config_cache.json"
 
 # Change these lines per application
 daemon_name = "example_smax_daemon"
 from example_hardware_interface import ExampleHardwareInterface as HardwareInterface
+from logging_scheduler import LoggingScheduler
+from smax_buffer import WriteAheadBuffer
+from config_compiler import ConfigError, compile_config, load_config
+from connection_link import Link
+from daemon_profiler import Profiler
 
 # Change between testing and production
+# This can be overridden with "logging_level" in daemon_config.json, or with the
+# EXAMPLE_SMAX_DAEMON_LOGGING_LEVEL environment variable.
 logging_level = logging.DEBUG
 #logging_level = logging.WARNING
+logging_level_env = f"{daemon_name.upper()}_LOGGING_LEVEL"
 
 logging.basicConfig(format='%(levelname)s - %(message)s', level=logging_level)
 
@@ -86,16 +103,49 @@ def _is_smaxconnectionerror(exception):
     return isinstance(exception, SmaxConnectionError)
 
 
+def _notify(status):
+    """Send a status notification to systemd"""
+    import systemd.daemon
+    systemd.daemon.notify(status)
+    
+_import_time = perf_counter() - _import_start
+
+
+class DaemonDevice:
+    """A hardware interface served by the daemon, and the SMA-X keys it is published under."""
+    def __init__(self, smax_key, control_keys, config):
+        """Create the record for one device. The hardware interface is created by ExampleSmaxService.start().
+        
+        Arguments:
+            smax_key (str) : the SMA-X key under smax_table for this device's data
+            control_keys (dict) : the names of the hardware interface callbacks, keyed by control key
+            config (dict) : dictionary of config values for the hardware interface"""
+        self.smax_key = smax_key
+        self.control_keys = control_keys
+        self.config = config
+        self.hardware = None
+        
+        # Cache of SMA-X (table, key) pairs and struct paths for each logged key
+        self.smax_pairs = {}
+
+
 class ExampleSmaxService:
-    def __init__(self, config=default_config, smax_config=default_smax_config):
+    def __init__(self, config=default_config, smax_config=default_smax_config, config_cache=default_config_cache):
         """Service object initialization code"""
         self.logger = self._init_logger()
         
+        # The file the compiled config is cached in, or None to compile it every time
+        self.config_cache = config_cache
+        
         # Configure SIGTERM behavior
         signal.signal(signal.SIGTERM, self._handle_sigterm)
+        # SIGHUP reloads the config
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+        # SIGUSR1 starts a profile
+        signal.signal(signal.SIGUSR1, self._handle_sigusr1)
 
-        # A list of control keys
-        self.control_keys = None
+        # The devices served by this daemon
+        self.devices = []
 
         # Read the hardware and SMAX configuration
         self.read_config(config, smax_config)
@@ -104,114 +154,500 @@ class ExampleSmaxService:
         # The SMAXRedisClient instance
         self.smax_client = None
         
-        # The hardware interface class
-        self.hardware = None
+        # The scheduler for reads of logged data
+        self.scheduler = None
+        
+        # The next time to publish timing metrics
+        self._next_metrics_time = None
+        
+        # Whether readings can be written straight to SMA-X. While False, readings are
+        # written to smax_buffer, and smax_link's thread reconnects and replays them.
+        self._smax_online = False
+        self._smax_lock = threading.Lock()
+        self.smax_buffer = None
+        # The number of buffered readings dropped because the buffer was full, as last logged
+        self._smax_buffer_dropped = 0
+        # The state of the SMA-X connection, and whether the client needs to reconnect and resubscribe
+        self.smax_link = Link("SMA-X", self._smax_recover, logger=self.logger)
+        self._smax_reconnect_needed = True
 
         # Log that we managed to create the instance
         self.logger.info(f'{daemon_name} instance created')
         
         # A time to delay between loops
         self.delay = 1.0
+        
+        # The event loop, when running in asyncio service mode
+        self._loop = None
+        self._stop_event = None
+        
+        # Set by request_reload(). The logging loop reloads the config between cycles, and
+        # is woken early from its sleep by _wake (or _wake_async in asyncio service mode).
+        self._reload_requested = False
+        self._wake = threading.Event()
+        self._wake_async = None
+        # Set by _log_device when load shedding changes a device's logging intervals
+        self._reschedule = False
+        
+        # Profiles are written next to the log file, and their summary shared to SMA-X
+        self.profiler = Profiler(os.path.dirname(self.log_file), daemon_name, logger=self.logger, on_done=self._publish_profile)
 
     def _init_logger(self):
         logger = logging.getLogger(__name__)
         logger.setLevel(logging_level)
         file_handler = logging.FileHandler(f'{daemon_name.lower()}.log')
-        file_handler.setLevel(logging_level)
+        self.log_file = file_handler.baseFilename
         fileFormatter = logging.Formatter('%(asctime)s: %(levelname)s - %(message)s')
         fileFormatter.default_msec_format = '%s.%03d'
         file_handler.setFormatter(fileFormatter)
-        logger.addHandler(file_handler)
+        
+        # Only the daemon's own messages go in the log file
+        file_handler.addFilter(logging.Filter(logger.name))
+        
+        # Write the log file and the console output from the listener's thread, so that I/O doesn't
+        # block the logging thread or pub/sub callbacks. The daemon's messages reach the queue through
+        # the root logger, whose handlers are moved to the listener until _stop_logging().
+        root = logging.getLogger()
+        self._console_handlers = list(root.handlers)
+        for handler in self._console_handlers:
+            root.removeHandler(handler)
+        log_queue = queue.SimpleQueue()
+        self._log_queue_handler = logging.handlers.QueueHandler(log_queue)
+        root.addHandler(self._log_queue_handler)
+        self._log_listener = logging.handlers.QueueListener(log_queue, file_handler, *self._console_handlers,
+                                                            respect_handler_level=True)
+        self._log_listener.start()
         return logger
+        
+    def _stop_logging(self):
+        """Write out the queued log messages, and give the console handlers back to the root logger"""
+        self._log_listener.stop()
+        root = logging.getLogger()
+        root.removeHandler(self._log_queue_handler)
+        for handler in self._console_handlers:
+            root.addHandler(handler)
+    
+    def set_logging_level(self, level):
+        """Set the level of the daemon's logging.
+        
+        Arguments:
+            level (str or int) : a logging level name such as "WARNING" or "STATUS", or a level number."""
+        if isinstance(level, str) and level.isdigit():
+            level = int(level)
+        if isinstance(level, str):
+            name = level
+            level = logging.getLevelName(name.upper())
+            if not isinstance(level, int):
+                raise ValueError(f"Unknown logging level {name}")
+        self.logger.setLevel(level)
+        logging.getLogger().setLevel(level)
     
     def read_config(self, config, smax_config=None):
-        """Read the configuration file."""
-        # Read the file
-        with open(config) as fp:
-            self._config = json.load(fp)
-            fp.close()
-        
-        # If smax_config is given, update the hardware specific config file with the smax_config
-        if smax_config:    
-            with open(smax_config) as fp:
-                s_config = json.load(fp)
-                fp.close()
-            self.logger.debug("Got smax_config")
-            self.logger.debug(s_config)
-            if "smax_table" in self._config["smax_config"]:
-                smax_root = s_config["smax_table"]
-                self._config["smax_config"]["smax_table"] = ":".join([smax_root, self._config["smax_config"]["smax_table"]])
-                del s_config["smax_table"]
-            self._config["smax_config"].update(s_config)
+        """Read the configuration files, merged with smax_config and validated.
+        
+        The compiled config is reused from the config cache if the files haven't changed.
+        Raises ConfigError if the config is invalid."""
+        compiled = load_config(config, smax_config, cache_file=self.config_cache)
+        self._config = compiled["config"]
+        # Kept for reloading the config
+        self.config_file = config
+        self.smax_config_file = smax_config
+        
+        # The environment variable takes precedence over the config file
+        level = os.environ.get(logging_level_env, self._config.get("logging_level", None))
+        if level is not None:
+            self.set_logging_level(level)
         
         # parse the _config dictionary and set up values
         self.smax_server = self._config["smax_config"]["smax_server"]
         self.smax_port = self._config["smax_config"]["smax_port"]
         self.smax_db = self._config["smax_config"]["smax_db"]
         self.smax_table = self._config["smax_config"]["smax_table"]
-        self.smax_key = self._config["smax_config"]["smax_key"]
+        self.batch_share = self._config["smax_config"].get("batch_share", False)
+        self.sample_metadata = self._config["smax_config"].get("sample_metadata", False)
+        self.reload_control_key = self._config["smax_config"].get("reload_control_key", None)
+        self.history_control_key = self._config["smax_config"].get("history_control_key", None)
+        self.profile_control_key = self._config["smax_config"].get("profile_control_key", None)
         
         self.logger.info("SMAX Configuration:")
         self.logger.info(f"\tSMAX Server: {self.smax_server}")
         self.logger.info(f"\tSMAX Port  : {self.smax_port}")
         self.logger.info(f"\tSMAx DB    : {self.smax_db}")
         self.logger.info(f"\tSMAX Table : {self.smax_table}")
-        self.logger.info(f"\tSMAX Key   : {self.smax_key}")
+        self.logger.info(f"\tBatch Share: {self.batch_share}")
+        self.logger.info(f"\tSample Metadata: {self.sample_metadata}")
         
-        
-        self.control_keys = self._config["smax_config"]["smax_control_keys"]
-        self.logger.info("Control keys:")
-        for k in self.control_keys.keys():
-            self.logger.info(f"\t {k} : {self.control_keys[k]}")
+        # The compiled config has already split the config into devices
+        self.devices = [DaemonDevice(d["smax_key"], d["control_keys"], d["config"]) for d in compiled["devices"]]
+            
+        for device in self.devices:
+            self.logger.info(f"Device {device.smax_key} control keys:")
+            for k in device.control_keys.keys():
+                self.logger.info(f"\t {k} : {device.control_keys[k]}")
         
         self.logging_interval = self._config["logging_interval"]
         self.logger.info(f"Logging Interval {self.logging_interval}")
+        
+        self.align_sampling = self._config.get("align_sampling", False)
+        self.logger.info(f"Align Sampling {self.align_sampling}")
+        
+        self.service_mode = self._config.get("service_mode", "thread")
+        self.logger.info(f"Service Mode {self.service_mode}")
+        
+        self.metrics_interval = self._config.get("metrics_interval", None)
+        self.logger.info(f"Metrics Interval {self.metrics_interval}")
+        
+        buffer_config = self._config.get("smax_buffer", {})
+        self.smax_buffer_path = buffer_config.get("path", "smax_buffer")
+        self.smax_buffer_max_records = buffer_config.get("max_records", 100000)
+        self.smax_buffer_segment_records = buffer_config.get("segment_records", 1000)
+        self.smax_replay_batch = buffer_config.get("replay_batch", 100)
+        self.smax_replay_rate = buffer_config.get("replay_rate", 1000)
+        self.logger.info(f"SMA-X Buffer {self.smax_buffer_path} max records {self.smax_buffer_max_records}")
 
     def start(self):
         """Code to be run before the service's main loop"""
         # Start up code
 
-        # Create the hardware interface
-        self.hardware = HardwareInterface(config=self._config, logger=self.logger)
-        self.logger.status('Created hardware interface object')
+        # Create the hardware interfaces
+        for device in self.devices:
+            device.hardware = HardwareInterface(config=device.config, logger=self.logger, name=device.smax_key)
+        self.logger.status(f'Created {len(self.devices)} hardware interface objects')
+        
+        # If align_sampling is set, each interval's reads fall on wall clock multiples of the interval
+        self.scheduler = LoggingScheduler(self.logging_groups(), wall_clock=time.time if self.align_sampling else None)
         
         # Create the SMA-X interface
         #
-        # There's no point to us starting without a SMA-X connection, so this will use 
-        self.connect_to_smax()
+        # Make one attempt to connect. If SMA-X can't be reached, start anyway, buffering
+        # readings while smax_link reconnects in the background.
+        try:
+            self._smax_connect()
+        except SmaxConnectionError:
+            pass
+        self.open_smax_buffer()
 
         # systemctl will wait until this notification is sent
         # Tell systemd that we are ready to run the service
-        systemd.daemon.notify(READY)
+        _notify(READY)
 
         # Run the service's main loop
         self.run()
     
-    @retry(wait_exponential_multiplier=1000, wait_exponential_max=30000, retry_on_exception=_is_smaxconnectionerror)
+    def open_smax_buffer(self):
+        """Open the buffer for readings made while SMA-X is unreachable, and start replaying
+        anything left in it by a previous run. Must be called after the first attempt to connect to SMA-X.
+        
+        If that attempt failed, smax_link starts reconnecting in the background."""
+        self.smax_buffer = WriteAheadBuffer(self.smax_buffer_path, max_records=self.smax_buffer_max_records,
+                                            segment_records=self.smax_buffer_segment_records)
+        if self._smax_reconnect_needed:
+            self.smax_link.lost(f'Could not connect to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
+        elif len(self.smax_buffer):
+            self.logger.status(f'Replaying {len(self.smax_buffer)} buffered readings')
+            self.smax_link.lost('Replaying buffered readings')
+        else:
+            self._smax_online = True
+            self.smax_link.connected()
+    
     def connect_to_smax(self):
         """creates a connection to SMA-X that we have to close properly when the
-        service terminates."""
+        service terminates.
+        
+        Blocks, retrying with exponential backoff, until the connection is made. start() does not
+        use this, and starts without SMA-X if necessary, but it is useful for tools such as the benchmarks."""
+        from retrying import retry
+        retry(wait_exponential_multiplier=1000, wait_exponential_max=30000,
+              retry_on_exception=_is_smaxconnectionerror)(self._smax_connect)()
+        
+    def _smax_connect(self):
+        """Make a single attempt to connect to SMA-X and subscribe to the control keys,
+        raising SmaxConnectionError if it fails."""
         try:
             if self.smax_client is None:
                 self.smax_client = SmaxRedisClient(redis_ip=self.smax_server, redis_port=self.smax_port, redis_db=self.smax_db, program_name="example_smax_daemon", \
-                                                    debug=logging_level==logging.DEBUG, logger=self.logger)
+                                                    debug=self.logger.isEnabledFor(logging.DEBUG), logger=self.logger)
             else:
                 self.smax_client.smax_connect_to(self.smax_server, self.smax_port, self.smax_db)
 
             self.logger.status(f'SMA-X client connected to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
+            self._smax_reconnect_needed = False
         except SmaxConnectionError as e:
             self.logger.warning(f'Could not connect to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')    
             raise e
         
-        # Register pubsub channels specified in config["smax_config"]["control_keys"] to the 
-        # callbacks specified in the config.
-        for k in self.control_keys.keys():
-            self.smax_client.smax_subscribe(join(self.smax_table, self.smax_key, k), callback=getattr(self.hardware, self.control_keys[k]))
-            self.logger.debug(f'connected {getattr(self.hardware, self.control_keys[k])} to {join(self.smax_table, self.smax_key, k)}')
+        # Register pubsub channels specified in each device's smax_control_keys to the 
+        # callbacks specified in the config, or generated from the declared bindings.
+        for device in self.devices:
+            self._subscribe_control_keys(device, device.control_keys)
+            self._subscribe_history_key(device)
+        if self.reload_control_key:
+            self.smax_client.smax_subscribe(join(self.smax_table, self.reload_control_key), callback=self._reload_callback)
+        if self.profile_control_key:
+            self.smax_client.smax_subscribe(join(self.smax_table, self.profile_control_key), callback=self._profile_callback)
         self.logger.info('Subscribed to pubsub notifications')
+        
+    def _subscribe_control_keys(self, device, control_keys):
+        """Subscribe to the control keys of device in control_keys, a dictionary of callback bindings"""
+        for k, binding in control_keys.items():
+            callback = device.hardware.control_callback(k, binding)
+            self.smax_client.smax_subscribe(join(self.smax_table, device.smax_key, k), callback=self._control_callback(device, k, callback))
+            self.logger.debug(f'connected {callback} to {join(self.smax_table, device.smax_key, k)}')
+            
+    def _unsubscribe_control_keys(self, device, control_keys):
+        """Unsubscribe from the control keys of device in control_keys"""
+        for k in control_keys:
+            self.smax_client.smax_unsubscribe(join(self.smax_table, device.smax_key, k))
+            self.logger.debug(f'disconnected {join(self.smax_table, device.smax_key, k)}')
+            
+    def _subscribe_history_key(self, device):
+        """Subscribe to the device's history_control_key, if there is one"""
+        if self.history_control_key:
+            self.smax_client.smax_subscribe(join(self.smax_table, device.smax_key, self.history_control_key),
+                                            callback=self._control_callback(device, self.history_control_key, partial(self._history_callback, device)))
+            
+    def _unsubscribe_history_key(self, device):
+        """Unsubscribe from the device's history_control_key, if there is one"""
+        if self.history_control_key:
+            self.smax_client.smax_unsubscribe(join(self.smax_table, device.smax_key, self.history_control_key))
+            
+    def _history_callback(self, device, message):
+        """Callback for a device's history_control_key.
+        
+        The request is either a logged data key, or a JSON object with the "key" and optional "start", "end"
+        and "bins" arguments of HardwareInterface.history(). The reply, or an "error", is written to the
+        struct smax_key:<history_control_key>_reply."""
+        try:
+            request = message.data
+            if isinstance(request, str) and request.lstrip().startswith("{"):
+                request = json.loads(request)
+            else:
+                request = {"key":str(request)}
+            reply = device.hardware.history(request["key"], start=request.get("start", None),
+                                            end=request.get("end", None), bins=request.get("bins", None))
+        except Exception as e:
+            reply = {"error":repr(e)}
+        self.smax_client.smax_share(self.smax_table, join(device.smax_key, f"{self.history_control_key}_reply"), reply)
+        
+    def _reload_callback(self, message):
+        """Callback for the reload_control_key"""
+        self.logger.status(f'Config reload requested by {message.origin}')
+        self.request_reload()
+        
+    def _profile_callback(self, message):
+        """Callback for the profile_control_key. The value is the duration of the profile in seconds,
+        or a JSON object of settings that override the profiling config."""
+        settings = {}
+        try:
+            if isinstance(message.data, str) and message.data.lstrip().startswith("{"):
+                settings = json.loads(message.data)
+            elif message.data:
+                settings = {"duration":float(message.data)}
+        except ValueError as e:
+            self.logger.warning(f'Ignoring profile settings {message.data!r}: {e}')
+        self.logger.status(f'Profile requested by {message.origin}')
+        self.request_profile(**settings)
+        
+    def request_profile(self, **settings):
+        """Start profiling the daemon in the background with the profiling config, updated with settings.
+        
+        Keyword Arguments are those of Profiler.start(). Unknown settings are ignored."""
+        config = {"duration":10, "top":20, "interval":0.005, "memory":True,
+                  "threads":["Logging", "HardwareRead", "HardwareCommands", "asyncio"]}
+        config.update(self._config.get("profiling", {}))
+        config.update({k:v for k, v in settings.items() if k in config})
+        if not self.profiler.start(**config):
+            self.logger.warning('A profile is already running')
+            
+    def _publish_profile(self, summary):
+        """Share a profile summary to SMA-X under smax_table:_profile"""
+        if not self._smax_online:
+            return
+        try:
+            self.smax_client.smax_share(self.smax_table, "_profile", summary)
+        except Exception as e:
+            self.logger.warning(f'Failed to write the profile summary with {e!r}')
+        
+    def request_reload(self):
+        """Ask the logging loop to reload the config before its next cycle. Safe to call from any thread."""
+        self._reload_requested = True
+        loop = self._loop
+        if loop is None:
+            self._wake.set()
+        else:
+            loop.call_soon_threadsafe(self._wake_async.set)
+            
+    def reload_config(self):
+        """Reread the config files, and apply the changes without interrupting the SMA-X connection.
+        
+        Only what the changes affect is rebuilt: the hardware interfaces are reconfigured with the
+        changed settings, control keys are resubscribed if their bindings changed, devices are added
+        or removed, and the logging schedule is updated, keeping the schedule of unchanged intervals.
+        
+        Must not run at the same time as a logging cycle - the logging loop calls it between cycles.
+        Changes to the SMA-X server settings, history_control_key, profile_control_key, service_mode, smax_buffer
+        and align_sampling need a restart, and are ignored.
+        If the new config is invalid, the current config is kept."""
+        try:
+            compiled = load_config(self.config_file, self.smax_config_file, cache_file=self.config_cache)
+        except Exception as e:
+            self.logger.error(f'Config reload failed, keeping the current config: {e}')
+            return
+        config = compiled["config"]
+        
+        # Keep the settings that can't be changed while running, so that _config describes the running daemon
+        for k in ("smax_server", "smax_port", "smax_db", "smax_table", "history_control_key", "profile_control_key"):
+            if config["smax_config"].get(k) != self._config["smax_config"].get(k):
+                self.logger.warning(f'Changing smax_config {k} needs a restart')
+                if k in self._config["smax_config"]:
+                    config["smax_config"][k] = self._config["smax_config"][k]
+                else:
+                    del config["smax_config"][k]
+        for k in ("service_mode", "smax_buffer", "align_sampling"):
+            if config.get(k) != self._config.get(k):
+                self.logger.warning(f'Changing {k} needs a restart')
+                if k in self._config:
+                    config[k] = self._config[k]
+                else:
+                    del config[k]
+        
+        level = os.environ.get(logging_level_env, config.get("logging_level", None))
+        if level is not None:
+            self.set_logging_level(level)
+        self.batch_share = config["smax_config"].get("batch_share", False)
+        self.sample_metadata = config["smax_config"].get("sample_metadata", False)
+        self.logging_interval = config["logging_interval"]
+        if config.get("metrics_interval", None) != self.metrics_interval:
+            self.metrics_interval = config.get("metrics_interval", None)
+            self._next_metrics_time = None
+        reload_control_key = config["smax_config"].get("reload_control_key", None)
+        
+        # Subscription changes are made once the devices have been updated, as (function, arguments) pairs
+        subscriptions = []
+        if reload_control_key != self.reload_control_key:
+            if self.reload_control_key:
+                subscriptions.append((lambda key: self.smax_client.smax_unsubscribe(key), (join(self.smax_table, self.reload_control_key),)))
+            if reload_control_key:
+                subscriptions.append((lambda key: self.smax_client.smax_subscribe(key, callback=self._reload_callback), (join(self.smax_table, reload_control_key),)))
+        self.reload_control_key = reload_control_key
+        
+        current = {device.smax_key:device for device in self.devices}
+        devices = []
+        for section in compiled["devices"]:
+            device = current.pop(section["smax_key"], None)
+            if device is None:
+                device = DaemonDevice(section["smax_key"], section["control_keys"], section["config"])
+                device.hardware = HardwareInterface(config=device.config, logger=self.logger, name=device.smax_key)
+                subscriptions.append((self._subscribe_control_keys, (device, device.control_keys)))
+                subscriptions.append((self._subscribe_history_key, (device,)))
+                self.logger.status(f'Added device {device.smax_key}')
+            else:
+                subscriptions.extend(self._reload_device(device, section["control_keys"], section["config"]))
+            devices.append(device)
+        for device in current.values():
+            device.hardware.close()
+            subscriptions.append((self._unsubscribe_control_keys, (device, device.control_keys)))
+            subscriptions.append((self._unsubscribe_history_key, (device,)))
+            self.logger.status(f'Removed device {device.smax_key}')
+        self.devices = devices
+        
+        # While SMA-X is disconnected, smax_link subscribes to all the control keys when it reconnects
+        if self.smax_client is not None and not self._smax_reconnect_needed:
+            try:
+                for function, args in subscriptions:
+                    function(*args)
+            except SmaxConnectionError as e:
+                self.logger.warning(f'Could not update control key subscriptions: {e!r}')
+                self._smax_lost(e)
+            
+        self._config = config
+        self.scheduler.update(self.logging_groups())
+        self.logger.status('Config reloaded')
+        
+    def _reload_device(self, device, control_keys, config):
+        """Apply a reloaded config to an existing device.
+        
+        Returns:
+            list : the subscription changes to make, as (function, arguments) pairs."""
+        fixed = ("smax_key", "smax_control_keys")
+        changed = {k:v for k, v in config.items() if k not in fixed and device.config.get(k, None) != v}
+        removed = [k for k in device.config if k not in fixed and k not in config]
+        old_control_keys = device.control_keys
+        device.config = config
+        device.control_keys = control_keys
+        
+        if removed:
+            # Settings can't be unset on a running interface, so replace it
+            self.logger.status(f'Recreating device {device.smax_key} to remove {", ".join(removed)}')
+            device.hardware.close()
+            device.hardware = HardwareInterface(config=config, logger=self.logger, name=device.smax_key)
+            device.smax_pairs = {}
+            return [(self._unsubscribe_control_keys, (device, old_control_keys)),
+                    (self._subscribe_control_keys, (device, control_keys))]
+        
+        if changed:
+            self.logger.status(f'Reconfiguring device {device.smax_key}: {", ".join(changed)}')
+            device.hardware.configure(changed)
+            if "hardware_process" in changed:
+                # The hardware is reconnected in or out of a worker process on the next cycle
+                device.hardware.disconnect_hardware()
+        rebound = {k for k in set(old_control_keys) | set(control_keys) if old_control_keys.get(k) != control_keys.get(k)}
+        return [(self._unsubscribe_control_keys, (device, [k for k in rebound if k in old_control_keys])),
+                (self._subscribe_control_keys, (device, {k:control_keys[k] for k in rebound if k in control_keys}))]
+        
+    def logging_groups(self):
+        """Return the logged data keys of all the devices grouped by logging interval.
+        
+        Returns:
+            dict : lists of (device, key) tuples, keyed by logging interval in seconds."""
+        groups = {}
+        for device in self.devices:
+            for interval, keys in device.hardware.logging_groups().items():
+                groups.setdefault(interval, []).extend((device, k) for k in keys)
+        return groups
+        
+    @staticmethod
+    def _group_by_device(due):
+        """Split a list of (device, key) tuples into a dictionary of lists of keys keyed by device."""
+        by_device = {}
+        for device, key in due:
+            by_device.setdefault(device, []).append(key)
+        return by_device
+        
+    def _control_callback(self, device, control_key, callback):
+        """Wrap a control key callback so that its run time is recorded in the device's metrics, and,
+        in asyncio service mode, it is dispatched through the event loop instead of running on the
+        smax-python pub/sub thread.
+        
+        The loop runs the callback in its executor, as callbacks such as the history request make
+        blocking SMA-X calls. Exceptions raised by the callback are logged."""
+        phase = join("callback", control_key)
+        def timed_callback(message):
+            start = perf_counter_ns()
+            try:
+                callback(message)
+            finally:
+                device.hardware.metrics.phase(phase, perf_counter_ns() - start)
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                self.logger.error(f"{device.smax_key}: {control_key} callback failed", exc_info=future.exception())
+        def submit(loop, message):
+            loop.run_in_executor(None, timed_callback, message).add_done_callback(done)
+        def dispatch(message):
+            loop = self._loop
+            if loop is None:
+                timed_callback(message)
+            else:
+                loop.call_soon_threadsafe(submit, loop, message)
+        return dispatch
 
     def run(self):
         """Run the main service loop"""
+        if self.service_mode == "asyncio":
+            import asyncio
+            asyncio.run(self.run_async())
+            self.stop()
+            return
         
         # Launch the logging thread as a daemon so that it can be shut down quickly
         self.logging_thread = threading.Thread(target=self.logging_loop, daemon=True, name='Logging')
@@ -229,67 +665,350 @@ class ExampleSmaxService:
             self.logger.status('SIGINT (keyboard interrupt) received...')
             self.stop()
             
+    async def run_async(self):
+        """Run the main service loop as asyncio tasks on a single event loop.
+        
+        Blocking hardware and SMA-X calls are run in the event loop's default executor.
+        Returns when SIGTERM or SIGINT is received."""
+        import asyncio
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._wake_async = asyncio.Event()
+        self._loop.add_signal_handler(signal.SIGTERM, self._handle_signal_async, 'SIGTERM')
+        self._loop.add_signal_handler(signal.SIGINT, self._handle_signal_async, 'SIGINT')
+        self._loop.add_signal_handler(signal.SIGHUP, self._handle_sighup, signal.SIGHUP, None)
+        self._loop.add_signal_handler(signal.SIGUSR1, self._handle_sigusr1, signal.SIGUSR1, None)
+        
+        logging_task = asyncio.ensure_future(self.logging_loop_async())
+        self.logger.status("Started logging task")
+        
+        try:
+            await self._stop_event.wait()
+        finally:
+            logging_task.cancel()
+            self._loop.remove_signal_handler(signal.SIGTERM)
+            self._loop.remove_signal_handler(signal.SIGINT)
+            self._loop.remove_signal_handler(signal.SIGHUP)
+            self._loop.remove_signal_handler(signal.SIGUSR1)
+            self._loop = None
+            
+    def _handle_signal_async(self, name):
+        self.logger.status(f'{name} received...')
+        self._stop_event.set()
+            
+    async def logging_loop_async(self):
+        """The logging loop as an asyncio task"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._reload_requested:
+                self._reload_requested = False
+                self._wake_async.clear()
+                try:
+                    # Keep logging with whatever of the config was applied
+                    await loop.run_in_executor(None, self.reload_config)
+                except Exception as e:
+                    self.logger.error(f'Config reload failed with {e!r}')
+            wait = self.scheduler.time_to_next()
+            if wait is None:
+                wait = self.logging_interval
+            if wait > 0:
+                # Sleep until the next group is due, or a reload is requested
+                try:
+                    await asyncio.wait_for(self._wake_async.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            due = self._group_by_device(self.scheduler.pop_due())
+            due_time = self.scheduler.last_due
+            self.logger.debug("tick")
+            # Run the devices concurrently
+            await asyncio.gather(*[loop.run_in_executor(None, self._log_device, device, keys, due_time) for device, keys in due.items()])
+            if self._reschedule:
+                self._reschedule = False
+                self.scheduler.update(self.logging_groups())
+            if self._metrics_due():
+                await loop.run_in_executor(None, self.publish_metrics)
+            
     def logging_loop(self):
         """The loop that will run in the thread to carry out logging"""
         while True:
+            if self._reload_requested:
+                self._reload_requested = False
+                self._wake.clear()
+                try:
+                    self.reload_config()
+                except Exception as e:
+                    # Keep logging with whatever of the config was applied
+                    self.logger.error(f'Config reload failed with {e!r}')
+            # Sleep until the next group of keys is due, or a reload is requested. The scheduler keeps each
+            # group on its own regular schedule, skipping any slots missed while smax_logging_action overran.
+            wait = self.scheduler.time_to_next()
+            if wait is None:
+                wait = self.logging_interval
+            if wait > 0:
+                self._wake.wait(wait)
+            due = self._group_by_device(self.scheduler.pop_due())
+            due_time = self.scheduler.last_due
             self.logger.debug("tick")
-            next_log_time = time.monotonic() + self.logging_interval
+            for device, keys in due.items():
+                self._log_device(device, keys, due_time)
+            if self._reschedule:
+                self._reschedule = False
+                self.scheduler.update(self.logging_groups())
+            if self._metrics_due():
+                self.publish_metrics()
+                
+    def _log_device(self, device, keys, due_time=None):
+        """Run smax_logging_action for one device, isolating any failure to that device.
+        
+        The cycle time is recorded in the device's metrics, and counted as an overrun
+        if it is longer than the shortest logging interval of keys. If due_time, the scheduled
+        time of the reads on the monotonic clock, is given, the lateness of the start of the
+        cycle is recorded as the sample_jitter phase. The cycle time is passed to the device's
+        load shedding, and the logging loop reschedules if its intervals change."""
+        metrics = device.hardware.metrics
+        if due_time is not None:
+            metrics.phase("sample_jitter", int((time.monotonic() - due_time)*1e9))
+            metrics.counters["missed_slots"] = self.scheduler.overruns
+        start = perf_counter_ns()
+        try:
+            self.smax_logging_action(device, keys)
+        except Exception as e:
+            self.logger.error(f'Logging for {device.smax_key} failed with {e!r}')
+        elapsed = perf_counter_ns() - start
+        metrics.phase("cycle", elapsed)
+        budget = device.hardware.logging_budget(keys)
+        if budget is not None and elapsed > budget*1e9:
+            metrics.overrun("cycle")
+        if device.hardware.adapt_load(elapsed/1e9, keys):
+            self._reschedule = True
+            
+    def _metrics_due(self):
+        """Return True if it is time to publish the timing metrics"""
+        if not self.metrics_interval:
+            return False
+        now = time.monotonic()
+        if self._next_metrics_time is None:
+            self._next_metrics_time = now + self.metrics_interval
+            return False
+        if now < self._next_metrics_time:
+            return False
+        self._next_metrics_time += self.metrics_interval
+        if self._next_metrics_time < now:
+            self._next_metrics_time = now + self.metrics_interval
+        return True
+        
+    def publish_metrics(self):
+        """Share each device's timing metrics to SMA-X under smax_key:_metrics"""
+        if not self._smax_online:
+            return
+        for device in self.devices:
+            device.hardware.metrics.counters["smax_buffer_dropped"] = self.smax_buffer.dropped
             try:
-                self.smax_logging_action()
+                self.smax_client.smax_share(self.smax_table, join(device.smax_key, "_metrics"), device.hardware.metrics.summary())
             except Exception as e:
-                pass
-
-            # Try to run on a regular schedule, but if smax_logging_action takes too long,
-            # just wait logging_interval between finishing one smax_logging_action and starting next.
-            curr_time = time.monotonic()
-            if next_log_time > curr_time:
-                time.sleep(next_log_time - curr_time)
-            else:
-                time.sleep(self.logging_interval)
-        
-    def smax_logging_action(self):
-        """Run the code to write logging data to SMAX"""
-        # If we've lost the connection, lets reconnect
-        # This will hang until a connection happens - this doesn't
-        # cost us anything, as we need an SMA-X connection to
-        # to do anything with the hardware.
+                self.logger.warning(f'Failed to write metrics for {device.smax_key} with {e!r}')
+        
+    def smax_logging_action(self, device, keys=None):
+        """Run the code to write logging data to SMAX
+        
+        Arguments:
+            device (DaemonDevice) : the device to read and share data from.
+        
+        Keyword Arguments:
+            keys (list) : the logged data keys to read and share. If None, share all the logged data."""
         # Gather data
         self.logger.debug("In logging action")
-        
-        if self.smax_client is None:
-            self.logger.warning(f'Lost SMA-X connection to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
-            self.connect_to_smax()
                 
-        logged_data = self.hardware.logging_action()
+        logged_data = device.hardware.logging_action(keys)
 
-        self.logger.status("Received data")    
+        self.logger.status("Received data from %s", device.smax_key)
+        
+        # Skip values that have not changed enough to be worth publishing
+        now = time.monotonic()
+        logged_data = device.hardware.publish_filter(logged_data, now)
+        if not logged_data:
+            return
+        sample_times = device.hardware.sample_times(logged_data) if self.sample_metadata else None
+        
+        # If SMA-X is unreachable, or buffered readings are still being replayed,
+        # add these readings to the buffer so that they are written in order
+        with self._smax_lock:
+            if not self._smax_online:
+                self._buffer_readings(device, logged_data, now, sample_times)
+                return
+        
         # write values to SMA-X
-        # Retry if connection is missing
         try:
-            for k in logged_data.keys():
-                self.logger.debug(f"key in logged_data.keys(): {k}")
-                table, key = normalize_pair(join(self.smax_table, self.smax_key), k)
-                self.smax_client.smax_share(table, key, logged_data[k])
-            self.logger.status(f'Wrote hardware data to SMAX ')
-        except SmaxConnectionError:
+            start = perf_counter_ns()
+            self._smax_share(device, logged_data, sample_times)
+            device.hardware.metrics.phase("smax_write", perf_counter_ns() - start)
+            device.hardware.mark_published(logged_data, now)
+            self.logger.status('Wrote hardware data to SMAX for %s', device.smax_key)
+        except SmaxConnectionError as e:
             self.logger.warning(f'Lost SMA-X connection to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
-            self.connect_to_smax()
-            self.smax_logging_action()
+            self._smax_lost(e)
+            with self._smax_lock:
+                self._buffer_readings(device, logged_data, now, sample_times)
+            
+    def _smax_share(self, device, logged_data, sample_times=None):
+        """Write the values in logged_data, and their sample times if given, to SMA-X under the device's smax_key"""
+        if self.batch_share:
+            self._smax_share_batch(device, logged_data, sample_times)
+        else:
+            self._smax_share_each(device, logged_data, sample_times)
+            
+    def _smax_struct(self, device, values):
+        """Assemble a dictionary of logged_data keys and values into a nested dictionary following their SMA-X keys"""
+        struct = {}
+        for k, v in values.items():
+            path = self._smax_pair(device, k)[2]
+            node = struct
+            for p in path[:-1]:
+                node = node.setdefault(p, {})
+            node[path[-1]] = v
+        return struct
+        
+    def _sample_times_struct(self, device, sample_times):
+        """Assemble the acquisition times and read durations of the readings into a struct of "acquired" and
+        "read_time" structs, each laid out like the values under the device's smax_key"""
+        return {"acquired":self._smax_struct(device, {k:t[0] for k, t in sample_times.items()}),
+                "read_time":self._smax_struct(device, {k:t[1] for k, t in sample_times.items()})}
+            
+    def _buffer_readings(self, device, logged_data, now, sample_times=None):
+        """Add readings to the SMA-X buffer with the wall clock time, and their sample times if
+        sample metadata is enabled. Must be called holding _smax_lock."""
+        self.smax_buffer.append([time.time(), device.smax_key, logged_data, sample_times])
+        # The readings will be written when the buffer is replayed
+        device.hardware.mark_published(logged_data, now)
+        if self.smax_buffer.dropped > self._smax_buffer_dropped:
+            self.logger.warning(f'SMA-X buffer full, dropped {self.smax_buffer.dropped - self._smax_buffer_dropped} '
+                                f'of the oldest buffered readings, {self.smax_buffer.dropped} in total')
+            self._smax_buffer_dropped = self.smax_buffer.dropped
+        
+    def _smax_lost(self, error):
+        """Buffer readings from now on, and reconnect to SMA-X and replay them in the background"""
+        with self._smax_lock:
+            self._smax_online = False
+            self._smax_reconnect_needed = True
+        self.smax_link.lost(repr(error))
+            
+    def _smax_recover(self):
+        """Reconnect to SMA-X if needed, then replay the buffered readings. Run by smax_link's reconnect thread,
+        which retries with jittered exponential backoff while this raises SmaxConnectionError.
+        
+        Returns when the buffer is empty, and readings are written straight to SMA-X again."""
+        if self._smax_reconnect_needed:
+            self._smax_connect()
+        self.smax_link.degraded('Replaying buffered readings')
+        try:
+            self._replay_smax_buffer({device.smax_key:device for device in self.devices})
+        except SmaxConnectionError:
+            self._smax_reconnect_needed = True
+            raise
+                
+    def _replay_smax_buffer(self, devices):
+        """Write the buffered readings to SMA-X in batches of smax_replay_batch records,
+        at up to smax_replay_rate records per second.
+        
+        The wall clock time each record was buffered at is written to the "acquired" metadata of
+        the device's smax_key, as the SMA-X timestamps are those of the replay."""
+        while True:
+            with self._smax_lock:
+                records = self.smax_buffer.read(self.smax_replay_batch)
+                if not records:
+                    self._smax_online = True
+                    self.logger.status('SMA-X buffer replayed, writing readings directly')
+                    return
+            start = time.monotonic()
+            for record in records:
+                if record is None or record[1] not in devices:
+                    continue
+                try:
+                    # Records buffered by older versions have no sample times
+                    self._smax_share(devices[record[1]], record[2], record[3] if len(record) > 3 else None)
+                    self.smax_client.smax_push_meta("acquired", join(self.smax_table, record[1]), record[0])
+                except SmaxConnectionError:
+                    raise
+                except Exception as e:
+                    self.logger.error(f'Dropped buffered readings for {record[1]} with {e!r}')
+            # Records appended while replaying may have dropped the segment that was read,
+            # which the buffer checks for under the same lock as the appends
+            with self._smax_lock:
+                self.smax_buffer.consume(len(records))
+            wait = len(records)/self.smax_replay_rate - (time.monotonic() - start)
+            if wait > 0:
+                time.sleep(wait)
+            
+    def _smax_pair(self, device, k):
+        """Return the cached (table, key, path) for logged key k of device.
+        
+        table and key are the normalized SMA-X pair used for individual shares, and path is
+        the position of the value within the struct at smax_table:smax_key used for batched shares."""
+        try:
+            return device.smax_pairs[k]
+        except KeyError:
+            table, key = normalize_pair(join(self.smax_table, device.smax_key), k)
+            pair = device.smax_pairs[k] = (table, key, tuple(k.split(":")))
+            return pair
+            
+    def _smax_share_each(self, device, logged_data, sample_times=None):
+        """Write each value in logged_data to SMA-X with its own smax_share call, and the sample times
+        of all of them as one struct."""
+        log_debug = self.logger.isEnabledFor(logging.DEBUG)
+        for k, v in logged_data.items():
+            if log_debug:
+                self.logger.debug("key in logged_data.keys(): %s", k)
+            table, key, _ = self._smax_pair(device, k)
+            self.smax_client.smax_share(table, key, v)
+        if sample_times:
+            self.smax_client.smax_share(self.smax_table, join(device.smax_key, "_sample_times"),
+                                        self._sample_times_struct(device, sample_times))
+            
+    def _smax_share_batch(self, device, logged_data, sample_times=None):
+        """Write all the values in logged_data to SMA-X in a single smax_share call.
+        
+        The values are assembled into a nested dictionary under the device's smax_key, which smax_share writes
+        as a struct in one pipelined submission. The sample times, if given, are added to the struct
+        under "_sample_times". If the struct can not be shared, the values of this write are written
+        individually instead, and the fallback is counted in the device's metrics."""
+        struct = self._smax_struct(device, logged_data)
+        if sample_times:
+            struct["_sample_times"] = self._sample_times_struct(device, sample_times)
+        try:
+            self.smax_client.smax_share(self.smax_table, device.smax_key, struct)
+        except SmaxConnectionError:
+            raise
+        except Exception as e:
+            counters = device.hardware.metrics.counters
+            counters["batch_share_fallbacks"] = counters.get("batch_share_fallbacks", 0) + 1
+            self.logger.warning(f'Batched share to {self.smax_table}:{device.smax_key} failed with {e!r}, falling back to per-key shares')
+            self._smax_share_each(device, logged_data, sample_times)
             
     def _handle_sigterm(self, sig, frame):
         self.logger.info('SIGTERM received...')
         self.stop()
+        
+    def _handle_sighup(self, sig, frame):
+        self.logger.status('SIGHUP received, reloading config...')
+        self.request_reload()
+
+    def _handle_sigusr1(self, sig, frame):
+        self.logger.status('SIGUSR1 received, profiling...')
+        self.request_profile()
 
     def stop(self):
         """Clean up after the service's main loop"""
         # Tell systemd that we received the stop signal
-        systemd.daemon.notify(STOPPING)
+        _notify(STOPPING)
 
         self.logger.status('Cleaning up...')
         
         # Clean up the hardware
         self.logger.status('Disconnecting hardware...')
-        self.hardware.disconnect_hardware()
+        for device in self.devices:
+            if device.hardware:
+                device.hardware.close()
 
         # Put the service's cleanup code here.
         if self.smax_client:
@@ -298,12 +1017,54 @@ class ExampleSmaxService:
             self.logger.status('SMA-X client disconnected')
         else:
             self.logger.warning('SMA-X client not found, nothing to clean up')
+        self.smax_link.close()
+        if self.smax_buffer is not None:
+            self.smax_buffer.close()
+            
+        # Flush the log file
+        self._stop_logging()
 
         # Exit to finally stop the serivce
         sys.exit(0)
 
 
+def check_config(config, smax_config):
+    """Compile and validate the config files, and print the startup timings.
+    
+    Returns:
+        int : the exit status - 0 if the config is valid, otherwise 1."""
+    start = perf_counter()
+    try:
+        compiled = compile_config(config, smax_config)
+    except (ConfigError, OSError, ValueError, KeyError) as e:
+        print(f"{config}: {e}")
+        return 1
+    compile_time = perf_counter() - start
+    
+    # Write the cache, then time loading the config from it
+    load_config(config, smax_config, cache_file=default_config_cache)
+    start = perf_counter()
+    load_config(config, smax_config, cache_file=default_config_cache)
+    cached_time = perf_counter() - start
+    
+    n_keys = sum(len(d["config"]["logged_data"]) for d in compiled["devices"])
+    print(f"{config}: OK, {len(compiled['devices'])} devices, {n_keys} logged keys")
+    print(f"Module imports:        {_import_time*1e3:8.1f} ms")
+    print(f"Config compile:        {compile_time*1e3:8.1f} ms")
+    print(f"Cached config load:    {cached_time*1e3:8.1f} ms")
+    return 0
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"{daemon_name} SMA-X daemon")
+    parser.add_argument("--config", default=default_config, help="daemon config file")
+    parser.add_argument("--smax-config", default=default_smax_config, help="SMA-X config file")
+    parser.add_argument("--check-config", action="store_true", help="validate the config files, print startup timings and exit")
+    args = parser.parse_args()
+    
+    if args.check_config:
+        sys.exit(check_config(args.config, args.smax_config))
+    
     # Do start up stuff
-    service = ExampleSmaxService()
+    service = ExampleSmaxService(config=args.config, smax_config=args.smax_config)
     service.start()
@@ -0,0 +1,227 @@
+# Host a hardware object in a worker subprocess
+#
+# A HardwareProxy creates the hardware object in its own process, and forwards
+# attribute gets and sets and method calls to it over a pipe. A slow or CPU bound
+# driver then runs on its own core without holding the daemon's GIL, and a driver
+# that hangs can be killed without taking the daemon with it.
+#
+# Each request waits at most `timeout` seconds for a reply. If the worker does not
+# reply in time, or dies, it is killed and the request raises an exception. The
+# worker is restarted by the next request, and is reconfigured with the original
+# config followed by every configure() call made through the proxy.
+#
+# Attribute values are copied between the processes, so an attribute that is an
+# object is returned as a snapshot, and changes made to it are not sent back.
+
+import inspect
+import multiprocessing
+import threading
+import types
+
+
+class HardwareTimeoutError(TimeoutError):
+    """A request to the hardware worker process did not complete in time."""
+
+
+class HardwareWorkerError(ConnectionError):
+    """The hardware worker process died or could not be started."""
+
+
+def _is_method(obj, name):
+    """Return True if attribute name of obj is a method, without calling any property getter"""
+    return isinstance(inspect.getattr_static(obj, name), (types.FunctionType, types.MethodType,
+                                                           staticmethod, classmethod))
+
+
+def _serve(conn, factory, config):
+    """The worker process - create the hardware object and serve requests until closed"""
+    try:
+        hardware = factory(config=config)
+        names = set(dir(hardware))
+        methods = {name for name in names if _is_method(hardware, name)}
+    except Exception as e:
+        conn.send(("error", e))
+        return
+    conn.send(("ok", (methods, names)))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        op, name, args = request
+        try:
+            if op == "call":
+                result = getattr(hardware, name)(*args)
+            elif op == "get":
+                result = getattr(hardware, name)
+            elif op == "set":
+                setattr(hardware, name, args)
+                result = None
+            elif op == "close":
+                conn.send(("ok", None))
+                return
+            else:
+                raise ValueError(f"Unknown hardware request {op}")
+            reply = ("ok", result)
+        except Exception as e:
+            reply = ("error", e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # The result or exception could not be pickled
+            conn.send(("error", RuntimeError(f"Could not return {op} {name}: {e!r}")))
+
+
+class _RemoteMethod:
+    """A method of the hardware object in the worker process."""
+    __slots__ = ("proxy", "name")
+
+    def __init__(self, proxy, name):
+        self.proxy = proxy
+        self.name = name
+
+    def __call__(self, *args):
+        return self.proxy._proxy_request("call", self.name, args)
+
+    def __repr__(self):
+        return f"<remote method {self.name} of {self.proxy!r}>"
+
+
+class HardwareProxy:
+    """A stand-in for a hardware object that runs in a worker subprocess.
+
+    Attributes and methods of the hardware object are used through the proxy as they would be
+    on the object itself. Requests are serialized, so only one runs in the worker at a time."""
+    def __init__(self, factory, config=None, timeout=10, start_method="spawn", logger=None):
+        """Start the worker process and create the hardware object in it.
+
+        Arguments:
+            factory (callable) : the hardware class, or a function that takes a config keyword argument
+                and returns the hardware object. Must be picklable, so it can be passed to the worker.
+
+        Keyword Arguments:
+            config (dict) : the config to create the hardware object with.
+            timeout (float) : the time in seconds to wait for each request, or None to wait forever.
+            start_method (str) : the multiprocessing start method for the worker. "spawn" is the default,
+                as forking a process with running threads is unsafe.
+            logger (logging.Logger) : logger for worker restarts."""
+        object.__setattr__(self, "_proxy_factory", factory)
+        object.__setattr__(self, "_proxy_config", dict(config) if config else {})
+        object.__setattr__(self, "_proxy_timeout", timeout)
+        object.__setattr__(self, "_proxy_context", multiprocessing.get_context(start_method))
+        object.__setattr__(self, "_proxy_logger", logger)
+        object.__setattr__(self, "_proxy_lock", threading.Lock())
+        object.__setattr__(self, "_proxy_process", None)
+        object.__setattr__(self, "_proxy_conn", None)
+        object.__setattr__(self, "_proxy_methods", set())
+        object.__setattr__(self, "_proxy_names", set())
+        object.__setattr__(self, "_proxy_bound", {})
+        object.__setattr__(self, "_proxy_closed", False)
+        # Number of times the worker has been restarted after a timeout or crash
+        object.__setattr__(self, "restarts", 0)
+
+        with self._proxy_lock:
+            self._proxy_start()
+
+    def _proxy_start(self):
+        """Start a worker process, and wait for it to create the hardware object. Must hold the lock."""
+        conn, worker_conn = self._proxy_context.Pipe()
+        process = self._proxy_context.Process(target=_serve, args=(worker_conn, self._proxy_factory, self._proxy_config),
+                                              daemon=True, name="HardwareWorker")
+        process.start()
+        worker_conn.close()
+        object.__setattr__(self, "_proxy_process", process)
+        object.__setattr__(self, "_proxy_conn", conn)
+        methods, names = self._proxy_reply("start")
+        object.__setattr__(self, "_proxy_methods", methods)
+        object.__setattr__(self, "_proxy_names", names)
+
+    def _proxy_kill(self):
+        """Kill the worker process. Must hold the lock."""
+        if self._proxy_conn is not None:
+            self._proxy_conn.close()
+        if self._proxy_process is not None:
+            self._proxy_process.kill()
+            self._proxy_process.join(1)
+        object.__setattr__(self, "_proxy_conn", None)
+        object.__setattr__(self, "_proxy_process", None)
+
+    def _proxy_reply(self, what):
+        """Wait for the reply to a request and return its result. Must hold the lock."""
+        try:
+            ready = self._proxy_conn.poll(self._proxy_timeout)
+            if ready:
+                status, result = self._proxy_conn.recv()
+        except (EOFError, OSError) as e:
+            self._proxy_kill()
+            raise HardwareWorkerError(f"Hardware worker died during {what}") from e
+        if not ready:
+            self._proxy_kill()
+            raise HardwareTimeoutError(f"Hardware worker timed out after {self._proxy_timeout} s during {what}")
+        if status == "error":
+            if what == "start":
+                self._proxy_kill()
+            raise result
+        return result
+
+    def _proxy_request(self, op, name, args=None):
+        """Send a request to the worker, restarting it first if it has died, and return the result"""
+        with self._proxy_lock:
+            if self._proxy_closed:
+                raise HardwareWorkerError("Hardware worker is closed")
+            if self._proxy_process is None:
+                object.__setattr__(self, "restarts", self.restarts + 1)
+                if self._proxy_logger:
+                    self._proxy_logger.warning(f"Restarting hardware worker (restart {self.restarts})")
+                self._proxy_start()
+            try:
+                self._proxy_conn.send((op, name, args))
+            except OSError as e:
+                self._proxy_kill()
+                raise HardwareWorkerError(f"Hardware worker died before {op} {name}") from e
+            return self._proxy_reply(f"{op} {name}")
+
+    def has_method(self, name):
+        """Return True if name is a method of the hardware object. Raises AttributeError if it is
+        not an attribute of the hardware object at all."""
+        if name in self._proxy_methods:
+            return True
+        if name not in self._proxy_names:
+            # Not listed by dir(), but it may still be provided by __getattr__
+            self._proxy_request("get", name)
+        return False
+
+    def configure(self, config):
+        """Configure the hardware object, and remember the config for worker restarts"""
+        self._proxy_request("call", "configure", (config,))
+        self._proxy_config.update(config)
+
+    def close(self):
+        """Stop the worker process"""
+        with self._proxy_lock:
+            object.__setattr__(self, "_proxy_closed", True)
+            if self._proxy_process is None:
+                return
+            try:
+                self._proxy_conn.send(("close", None, None))
+                self._proxy_conn.poll(1)
+            except OSError:
+                pass
+            self._proxy_kill()
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name in self._proxy_methods:
+            try:
+                return self._proxy_bound[name]
+            except KeyError:
+                return self._proxy_bound.setdefault(name, _RemoteMethod(self, name))
+        return self._proxy_request("get", name)
+
+    def __setattr__(self, name, value):
+        self._proxy_request("set", name, value)
+
+    def __repr__(self):
+        return f"HardwareProxy({getattr(self._proxy_factory, '__name__', self._proxy_factory)!r})"
@@ -15,6 +15,18 @@ mkdir -p "$CONFIG/example_smax_daemon"
 
 cp "./example_smax_daemon.py" $INSTALL
 cp "./example_hardware_interface.py" $INSTALL
+cp "./logging_scheduler.py" $INSTALL
+cp "./daemon_metrics.py" $INSTALL
+cp "./smax_buffer.py" $INSTALL
+cp "./command_queue.py" $INSTALL
+cp "./hardware_proxy.py" $INSTALL
+cp "./config_compiler.py" $INSTALL
+cp "./connection_link.py" $INSTALL
+cp "./sample_history.py" $INSTALL
+cp "./daemon_profiler.py" $INSTALL
+cp "./load_shedding.py" $INSTALL
+cp "./publish_policy.py" $INSTALL
+cp "./read_cache.py" $INSTALL
 cp "./example_smax_daemon.service" $INSTALL
 cp "./on_start.sh" $INSTALL
 
@@ -0,0 +1,101 @@
+# Adaptive load shedding for logging cycles that overrun their time budget
+#
+# Each logged value has a priority. When a cycle takes longer than its budget, the
+# lowest priority values still being read are shed - skipped until the load drops.
+# Once only the highest priority values are left, the logging intervals are backed
+# off instead, doubling up to a limit. After enough cycles well inside the budget,
+# the intervals recover first, then the shed priorities are restored one at a time.
+# If a recovery step overruns again, the number of cycles to wait before the next
+# attempt doubles, so a daemon that is close to saturation doesn't oscillate.
+
+
+class LoadShedder:
+    """The shedding and interval backoff state of one device."""
+    def __init__(self, budget=0.8, max_backoff=8, recover_cycles=10, logger=None, name="Load shedding"):
+        """Keyword Arguments:
+            budget (float) : the time budget of a cycle as a fraction of its logging interval.
+            max_backoff (float) : the largest factor the logging intervals are multiplied by.
+            recover_cycles (int) : the number of consecutive cycles taking less than half the budget
+                before one step of backoff or shedding is undone.
+            logger (logging.Logger) : logger for changes of shedding and backoff.
+            name (str) : the name of the device, for log messages."""
+        self.budget = budget
+        self.max_backoff = max_backoff
+        self.recover_cycles = recover_cycles
+        self.logger = logger
+        self.name = name
+
+        # The factor the logging intervals are multiplied by
+        self.backoff = 1
+        # The distinct priorities of the logged values, lowest first, and the number of them that are shed
+        self.priorities = [0]
+        self.shed = 0
+        # The total number of reads skipped by shedding
+        self.shed_count = 0
+        self._good_cycles = 0
+        # The number of good cycles needed before the next recovery step, and whether the last step is on trial
+        self._recover_after = recover_cycles
+        self._probing = False
+
+    @property
+    def min_priority(self):
+        """The lowest priority of the values that are read"""
+        return self.priorities[self.shed]
+
+    def set_priorities(self, priorities):
+        """Set the priorities of the logged values, and stop shedding"""
+        self.priorities = sorted(set(priorities)) or [0]
+        self.shed = 0
+
+    def _log(self, message, recovering=False):
+        if self.logger:
+            if recovering:
+                self.logger.status(f'{self.name}: {message}')
+            else:
+                self.logger.warning(f'{self.name}: {message}')
+
+    def update(self, elapsed, interval):
+        """Adapt to the duration of a cycle.
+
+        Arguments:
+            elapsed (float) : the time the cycle took in seconds.
+            interval (float) : the shortest logging interval of the values read in the cycle, before backoff.
+
+        Returns:
+            bool : True if the backoff changed, so the logging intervals must be rescheduled."""
+        budget = self.budget*interval*self.backoff
+        if elapsed > budget:
+            self._good_cycles = 0
+            if self._probing:
+                # The last recovery step was too soon
+                self._probing = False
+                self._recover_after = min(self._recover_after*2, self.recover_cycles*64)
+            if self.shed < len(self.priorities) - 1:
+                self.shed += 1
+                self._log(f'cycle took {elapsed:.3f} s, over its {budget:.3f} s budget, shedding values with priority below {self.min_priority}')
+                return False
+            if self.backoff < self.max_backoff:
+                self.backoff = min(self.backoff*2, self.max_backoff)
+                self._log(f'cycle took {elapsed:.3f} s, over its {budget:.3f} s budget, backing off logging intervals x{self.backoff:g}')
+                return True
+            return False
+
+        if elapsed >= budget/2:
+            self._good_cycles = 0
+            return False
+        self._good_cycles += 1
+        if self._good_cycles < self._recover_after:
+            return False
+        self._good_cycles = 0
+        if self._probing:
+            # The last recovery step has held
+            self._recover_after = self.recover_cycles
+        self._probing = self.backoff > 1 or self.shed > 0
+        if self.backoff > 1:
+            self.backoff = max(self.backoff/2, 1)
+            self._log(f'recovering, logging intervals x{self.backoff:g}', recovering=True)
+            return True
+        if self.shed:
+            self.shed -= 1
+            self._log(f'recovering, reading values with priority {self.min_priority} and above', recovering=True)
+        return False
@@ -0,0 +1,112 @@
+# A deadline scheduler for logged data with per-key logging intervals
+#
+# Keys that share a logging interval are grouped together, and each group
+# has a single entry in a heap ordered by the next time it is due.
+#
+# Optionally, each group's slots are aligned to wall clock multiples of its interval,
+# so that a 10 s group is read at :00, :10, :20... and groups whose intervals
+# divide into each other are read together.
+
+import heapq
+import math
+import time
+
+
+class LoggingScheduler:
+    """Schedule reads of logged data keys, each with its own logging interval."""
+    def __init__(self, groups, clock=time.monotonic, wall_clock=None):
+        """Create a scheduler for the given groups of keys.
+
+        Arguments:
+            groups (dict) : dictionary of lists of keys, keyed by logging interval in seconds.
+
+        Keyword Arguments:
+            clock (callable) : monotonic clock returning the time in seconds.
+            wall_clock (callable) : if given, a wall clock such as time.time to align the slots of each
+                group to multiples of its interval. Groups are then first due at their next boundary."""
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.overruns = 0
+        # The deadline of the earliest group returned by the last pop_due(), on the monotonic clock
+        self.last_due = None
+        self._heap = []
+        self.reset(groups)
+
+    def _origin(self, interval, now, earliest=None):
+        """Return the time of the first slot for a group with interval, on the monotonic clock.
+
+        The slot is at earliest, or now if earliest is None or has passed, moved on to the next boundary if aligned."""
+        start = now if earliest is None else max(earliest, now)
+        if self.wall_clock is None:
+            return start
+        return start + (-(self.wall_clock() + start - now)) % interval
+
+    def reset(self, groups):
+        """Replace the scheduled groups. All groups are due immediately, or at their next boundary if aligned."""
+        now = self.clock()
+        # Each entry is [deadline, interval, keys, origin, slot], where deadline = origin + slot*interval.
+        # Computing the deadline from the slot number avoids accumulating rounding errors.
+        self._heap = []
+        for interval, keys in groups.items():
+            if keys:
+                origin = self._origin(interval, now)
+                self._heap.append([origin, interval, list(keys), origin, 0])
+        heapq.heapify(self._heap)
+
+    def update(self, groups):
+        """Replace the scheduled groups, keeping the schedule of any interval that is still in use.
+
+        A group with a new interval is first due one new interval after the last scheduled read of the
+        earliest of its keys that was already scheduled, or immediately if that time has passed. Groups of
+        keys that were not scheduled before are due immediately. If aligned, these wait for their next boundary."""
+        now = self.clock()
+        existing = {}
+        last_slot = {}
+        for entry in self._heap:
+            existing[entry[1]] = entry
+            for key in entry[2]:
+                last_slot[key] = entry[0] - entry[1]
+        heap = []
+        for interval, keys in groups.items():
+            if not keys:
+                continue
+            entry = existing.get(interval, None)
+            if entry is None:
+                earliest = min((last_slot[k] + interval for k in keys if k in last_slot), default=None)
+                origin = self._origin(interval, now, earliest)
+                entry = [origin, interval, list(keys), origin, 0]
+            else:
+                entry[2] = list(keys)
+            heap.append(entry)
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def time_to_next(self):
+        """Return the time in seconds until the next group is due, or None if nothing is scheduled."""
+        if not self._heap:
+            return None
+        return self._heap[0][0] - self.clock()
+
+    def pop_due(self):
+        """Return the keys of all groups that are now due, and schedule their next reads.
+
+        Deadlines advance by whole intervals from the previous deadline rather than from the
+        current time, so that the schedule does not drift. If a group has fallen behind by one
+        or more whole intervals, the missed slots are skipped and counted as overruns."""
+        now = self.clock()
+        keys = []
+        if self._heap and self._heap[0][0] <= now:
+            self.last_due = self._heap[0][0]
+        while self._heap and self._heap[0][0] <= now:
+            entry = self._heap[0]
+            keys.extend(entry[2])
+            entry[4] += 1
+            deadline = entry[3] + entry[4] * entry[1]
+            if deadline <= now:
+                missed = math.floor((now - deadline) / entry[1]) + 1
+                self.overruns += missed
+                entry[4] += missed
+                deadline = entry[3] + entry[4] * entry[1]
+            entry[0] = deadline
+            heapq.heapreplace(self._heap, entry)
+        return keys
@@ -0,0 +1,73 @@
+# Publish policies for logged values
+#
+# A policy decides whether a new reading of a value is worth writing to SMA-X,
+# either always, or only when it has changed by more than a deadband since it was
+# last published. Values that haven't changed can still be republished after a
+# maximum time, so that their SMA-X timestamps show they are still being read.
+
+import math
+import numbers
+
+
+class PublishPolicy:
+    """When to publish a logged value to SMA-X.
+    
+    `mode` is "always" to publish every reading, or "on_change" to publish only when the value differs
+    from the last published value. Numeric values must also differ by more than `deadband`, and by
+    more than `deadband_rel` times the last published value. If `max_silence` is set, the value is
+    republished at least every `max_silence` seconds even if it has not changed."""
+    __slots__ = ("mode", "deadband", "deadband_rel", "max_silence")
+    
+    def __init__(self, mode="always", deadband=0, deadband_rel=0, max_silence=None):
+        if mode not in ("always", "on_change"):
+            raise ValueError(f"Unknown publish policy {mode}")
+        for name, value in (("deadband", deadband), ("deadband_rel", deadband_rel), ("max_silence", max_silence)):
+            if value is None and name == "max_silence":
+                continue
+            if not isinstance(value, numbers.Real) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"{name} must be a non-negative number, not {value!r}")
+        self.mode = mode
+        self.deadband = deadband
+        self.deadband_rel = deadband_rel
+        self.max_silence = max_silence
+        
+    @classmethod
+    def from_config(cls, entry, default=None):
+        """Create a policy from the publish settings of a logged_data entry, falling back to default
+        for any settings not given. Giving a deadband implies "on_change"."""
+        if default is None:
+            default = cls()
+        if not entry or not any(k in entry for k in ("publish", "deadband", "deadband_rel", "max_silence")):
+            return default
+        if "publish" in entry:
+            mode = entry["publish"]
+        elif "deadband" in entry or "deadband_rel" in entry:
+            mode = "on_change"
+        else:
+            mode = default.mode
+        return cls(mode,
+                   entry.get("deadband", default.deadband),
+                   entry.get("deadband_rel", default.deadband_rel),
+                   entry.get("max_silence", default.max_silence))
+        
+    def should_publish(self, value, last, now):
+        """Return True if value should be published, given the last published [value, time], or None
+        if it has never been published."""
+        if self.mode == "always" or last is None:
+            return True
+        last_value, last_time = last
+        if self.max_silence is not None and now - last_time >= self.max_silence:
+            return True
+        if isinstance(value, (int, float)) and isinstance(last_value, (int, float)) \
+                and not isinstance(value, bool) and not isinstance(last_value, bool):
+            if math.isnan(value) or math.isnan(last_value):
+                # NaN differs from everything, including itself, so publish when a value becomes
+                # or stops being NaN, but not while it stays NaN
+                return math.isnan(value) != math.isnan(last_value)
+            change = abs(value - last_value)
+            return change > 0 and change > self.deadband and change > self.deadband_rel*abs(last_value)
+        try:
+            return bool(value != last_value)
+        except (TypeError, ValueError):
+            # Values such as arrays that can't be compared simply are always published
+            return True
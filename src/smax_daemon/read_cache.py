@@ -0,0 +1,44 @@
+# A read-through cache of hardware attribute values
+#
+# Several logged values are often derived from the same hardware attribute, so
+# each attribute is read from the hardware at most once per logging sweep.
+# Expensive attributes can also be kept for a time to live across sweeps.
+
+import time
+
+
+class ReadCache:
+    """A read-through cache of hardware attribute values.
+    
+    A cached value is reused for the rest of the sweep it was read in, and, if `ttl` is
+    set, until it is `ttl` seconds old. Function calls are never cached."""
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._sweep = 0
+        # name : (value, sweep, monotonic time read)
+        self._values = {}
+        
+    def new_sweep(self):
+        """Start a new sweep, after which values are only reused within their ttl"""
+        self._sweep += 1
+        
+    def get(self, obj, name):
+        """Return attribute name of obj, from the cache if it is still valid"""
+        entry = self._values.get(name)
+        if entry is not None and (entry[1] == self._sweep or (self.ttl and time.monotonic() - entry[2] < self.ttl)):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = getattr(obj, name)
+        self._values[name] = (value, self._sweep, time.monotonic())
+        return value
+        
+    def invalidate(self, names=None):
+        """Remove the cached values of names, or of all attributes if names is None"""
+        if names is None:
+            self._values = {}
+        else:
+            for name in names:
+                self._values.pop(name, None)
@@ -0,0 +1,124 @@
+# Fixed size in-memory history of logged values
+#
+# Each value's history is held in a pair of preallocated array('d') ring buffers,
+# one of timestamps and one of values, so a sample costs 16 bytes and no Python
+# objects. Queries return a time window of samples, or the window downsampled into
+# bins of mean, min, max and count, using NumPy if it is installed.
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SampleHistory:
+    """The last `size` samples of a numeric value, with their timestamps."""
+    __slots__ = ("size", "count", "_times", "_values", "_next")
+
+    def __init__(self, size):
+        """Arguments:
+            size (int) : the number of most recent samples to keep."""
+        self.size = size
+        # The total number of samples appended
+        self.count = 0
+        self._times = array("d", bytes(8*size))
+        self._values = array("d", bytes(8*size))
+        self._next = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, value):
+        """Add a sample taken at time t. Raises TypeError if value is not a number."""
+        i = self._next
+        self._values[i] = value
+        self._times[i] = t
+        i += 1
+        self._next = i if i < self.size else 0
+        self.count += 1
+
+    def _ordered(self):
+        """Return the times and values arrays, oldest first"""
+        if self.count < self.size:
+            return self._times[:self.count], self._values[:self.count]
+        i = self._next
+        return self._times[i:] + self._times[:i], self._values[i:] + self._values[:i]
+
+    def window(self, start=None, end=None):
+        """Return the samples with start <= time <= end, oldest first.
+
+        Keyword Arguments:
+            start (float) : the earliest time to return, or None for the oldest sample.
+            end (float) : the latest time to return, or None for the newest sample.
+
+        Returns:
+            (array, array) : the times and values of the samples."""
+        times, values = self._ordered()
+        lo = 0 if start is None else bisect_left(times, start)
+        hi = len(times) if end is None else bisect_right(times, end)
+        return times[lo:hi], values[lo:hi]
+
+    def aggregate(self, bins, start=None, end=None):
+        """Downsample the samples with start <= time <= end into equal width time bins.
+
+        Arguments:
+            bins (int) : the number of bins to divide the window into.
+
+        Keyword Arguments:
+            start (float) : the start of the window, or None for the time of the oldest sample.
+            end (float) : the end of the window, or None for the time of the newest sample.
+
+        Returns:
+            dict : lists of the start "time", "mean", "min", "max" and "count" of each bin that has samples."""
+        times, values = self.window(start, end)
+        result = {"time":[], "mean":[], "min":[], "max":[], "count":[]}
+        if not times:
+            return result
+        if start is None:
+            start = times[0]
+        if end is None:
+            end = times[-1]
+        width = (end - start)/bins
+        if width <= 0:
+            bins, width = 1, 1.0
+
+        if np is not None:
+            t = np.frombuffer(times)
+            v = np.frombuffer(values)
+            index = np.minimum(((t - start)//width).astype(int), bins - 1)
+            count = np.bincount(index, minlength=bins)
+            total = np.bincount(index, weights=v, minlength=bins)
+            low = np.full(bins, np.inf)
+            high = np.full(bins, -np.inf)
+            np.minimum.at(low, index, v)
+            np.maximum.at(high, index, v)
+            used = np.nonzero(count)[0]
+            result["time"] = (start + used*width).tolist()
+            result["mean"] = (total[used]/count[used]).tolist()
+            result["min"] = low[used].tolist()
+            result["max"] = high[used].tolist()
+            result["count"] = count[used].tolist()
+            return result
+
+        stats = {}
+        for t, v in zip(times, values):
+            i = min(int((t - start)//width), bins - 1)
+            s = stats.get(i)
+            if s is None:
+                stats[i] = [v, v, v, 1]
+            else:
+                s[0] += v
+                s[1] = min(s[1], v)
+                s[2] = max(s[2], v)
+                s[3] += 1
+        for i in sorted(stats):
+            total, low, high, count = stats[i]
+            result["time"].append(start + i*width)
+            result["mean"].append(total/count)
+            result["min"].append(low)
+            result["max"].append(high)
+            result["count"].append(count)
+        return result
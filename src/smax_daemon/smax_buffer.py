@@ -0,0 +1,132 @@
+# A bounded on-disk buffer for readings that could not be written to SMA-X
+#
+# Records are appended as JSON lines to a ring of segment files. When the
+# buffer is full, the oldest segment is deleted to make room for new records.
+# Records are read back oldest first, and removed once they have been consumed.
+#
+# The read position within the oldest segment is not saved to disk, so after a
+# restart some records may be replayed twice.
+
+import json
+import os
+import threading
+
+
+def _json_default(value):
+    """Convert values that json can't serialize, such as NumPy arrays and scalars"""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return repr(value)
+
+
+class WriteAheadBuffer:
+    """A bounded, append-only buffer of JSON records, stored as a ring of segment files."""
+    def __init__(self, path, max_records=100000, segment_records=1000):
+        """Open the buffer in the directory path, picking up any records left by a previous run.
+
+        Arguments:
+            path (str) : the directory to store the segment files in. Created if it doesn't exist.
+
+        Keyword Arguments:
+            max_records (int) : the approximate maximum number of records to keep.
+            segment_records (int) : the number of records in each segment file."""
+        self.path = path
+        self.segment_records = segment_records
+        self.max_segments = max(2, -(-max_records // segment_records))
+        # Number of records dropped because the buffer was full
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._write_fp = None
+        # [segment number, record count] for each segment file, oldest first
+        self._segments = []
+        # The number of records already consumed from the oldest segment
+        self._read_offset = 0
+        # The segment number and offset of the last read, checked by consume()
+        self._last_read = None
+
+        os.makedirs(path, exist_ok=True)
+        for name in sorted(os.listdir(path)):
+            base, ext = os.path.splitext(name)
+            if ext == ".jsonl" and base.isdigit():
+                with open(os.path.join(path, name)) as fp:
+                    self._segments.append([int(base), sum(1 for _ in fp)])
+        self._segments.sort()
+
+    def __len__(self):
+        with self._lock:
+            return sum(count for _, count in self._segments) - self._read_offset
+
+    def _segment_file(self, number):
+        return os.path.join(self.path, f"{number:012d}.jsonl")
+
+    def _drop_oldest(self):
+        number, count = self._segments.pop(0)
+        self.dropped += count - self._read_offset
+        self._read_offset = 0
+        os.remove(self._segment_file(number))
+
+    def append(self, record):
+        """Append a JSON serializable record to the buffer"""
+        line = json.dumps(record, default=_json_default) + "\n"
+        with self._lock:
+            if self._write_fp is None or self._segments[-1][1] >= self.segment_records:
+                if self._write_fp is not None:
+                    self._write_fp.close()
+                number = self._segments[-1][0] + 1 if self._segments else 0
+                while len(self._segments) >= self.max_segments:
+                    self._drop_oldest()
+                self._segments.append([number, 0])
+                self._write_fp = open(self._segment_file(number), "a")
+            self._write_fp.write(line)
+            self._write_fp.flush()
+            self._segments[-1][1] += 1
+
+    def read(self, n):
+        """Return up to n of the oldest records without removing them.
+
+        Only records from the oldest segment are returned, so fewer than n records
+        may be returned even if more are buffered."""
+        with self._lock:
+            if not self._segments:
+                return []
+            number, count = self._segments[0]
+            self._last_read = (number, self._read_offset)
+            records = []
+            with open(self._segment_file(number)) as fp:
+                for i, line in enumerate(fp):
+                    if i < self._read_offset:
+                        continue
+                    if len(records) >= n:
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A partial line left by a crash
+                        records.append(None)
+            return records
+
+    def consume(self, n):
+        """Remove the n oldest records, which must have been returned by the last read().
+
+        If the segment they were read from has since been dropped to make room, they are already
+        gone, and nothing is removed."""
+        with self._lock:
+            last_read, self._last_read = self._last_read, None
+            if not self._segments or last_read != (self._segments[0][0], self._read_offset):
+                return
+            self._read_offset += n
+            number, count = self._segments[0]
+            if self._read_offset >= count:
+                if len(self._segments) == 1 and self._write_fp is not None:
+                    self._write_fp.close()
+                    self._write_fp = None
+                self._segments.pop(0)
+                self._read_offset = 0
+                os.remove(self._segment_file(number))
+
+    def close(self):
+        with self._lock:
+            if self._write_fp is not None:
+                self._write_fp.close()
+                self._write_fp = None
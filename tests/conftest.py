@@ -0,0 +1,9 @@
+# The daemon's modules are run as scripts from src/smax_daemon rather than installed
+# as a package, so make them importable the same way for the tests.
+
+import os
+import sys
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, _src)
+sys.path.insert(0, os.path.join(_src, "smax_daemon"))
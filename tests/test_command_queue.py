@@ -0,0 +1,94 @@
+import threading
+import time
+
+from command_queue import CommandQueue
+
+
+class Recorder:
+    """An apply function that records its calls, and can be held until released"""
+    def __init__(self):
+        self.calls = []
+        self.times = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.called = threading.Event()
+
+    def __call__(self, config):
+        self.calls.append(dict(config))
+        self.times.append(time.monotonic())
+        self.called.set()
+        self.gate.wait(5)
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+def test_writes_are_applied():
+    recorder = Recorder()
+    queue = CommandQueue(recorder)
+    queue.put("a", 1)
+    wait_for(lambda: queue.applied == 1)
+    assert recorder.calls == [{"a":1}]
+    assert queue.depth == 0
+
+
+def test_pending_writes_are_coalesced():
+    recorder = Recorder()
+    recorder.gate.clear()
+    queue = CommandQueue(recorder)
+    queue.put("a", 1)
+    assert recorder.called.wait(5)
+    # While the first write is being applied, later writes to the same attribute replace each other,
+    # and writes to other attributes are applied with them
+    queue.put("a", 2)
+    queue.put("a", 3)
+    queue.put("b", 4)
+    assert queue.depth == 2
+    recorder.gate.set()
+    wait_for(lambda: queue.applied == 3)
+    assert recorder.calls == [{"a":1}, {"a":3, "b":4}]
+    assert queue.coalesced == 1
+
+
+def test_failed_apply_is_not_counted():
+    def fail(config):
+        raise RuntimeError("hardware error")
+
+    queue = CommandQueue(fail)
+    queue.put("a", 1)
+    wait_for(lambda: queue.depth == 0)
+    time.sleep(0.01)
+    assert queue.applied == 0
+
+
+def test_rate_limit():
+    recorder = Recorder()
+    queue = CommandQueue(recorder)
+    queue.set_rate_limit("slow", 20)
+    queue.put("slow", 1)
+    wait_for(lambda: queue.applied == 1)
+    queue.put("slow", 2)
+    queue.put("fast", 3)
+    wait_for(lambda: queue.applied == 3)
+    # The unlimited write goes straight away, the limited one waits 50 ms after the last
+    assert recorder.calls == [{"slow":1}, {"fast":3}, {"slow":2}]
+    assert recorder.times[2] - recorder.times[0] >= 0.045
+
+
+def test_close_stops_the_worker():
+    recorder = Recorder()
+    queue = CommandQueue(recorder)
+    queue.put("a", 1)
+    wait_for(lambda: queue.applied == 1)
+    queue.close(timeout=5)
+    assert not queue._thread.is_alive()
+    # Later writes are dropped
+    queue.put("a", 2)
+    time.sleep(0.01)
+    assert recorder.calls == [{"a":1}]
+    assert queue.depth == 0
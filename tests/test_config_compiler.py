@@ -0,0 +1,154 @@
+import json
+import os
+
+import pytest
+
+import config_compiler
+from config_compiler import ConfigError, compile_config, load_config
+
+
+SMAX_CONFIG = {"smax_server":"localhost", "smax_port":6379, "smax_db":0, "smax_table":"test"}
+
+
+def base_config(**settings):
+    config = {
+        "logging_interval":1,
+        "smax_config":dict(SMAX_CONFIG, smax_key="device"),
+        "logged_data":{"random_number":{"type":"float"}, "group":{"base":{"attribute":"random_base"}}},
+        "config":{"random_base":0.0, "random_range":1.0},
+    }
+    config.update(settings)
+    return config
+
+
+def write_config(path, config):
+    with open(path, "w") as fp:
+        json.dump(config, fp)
+    return str(path)
+
+
+@pytest.fixture
+def compile_(tmp_path):
+    """Compile a config dictionary, which needs the hardware interface and so smax-python"""
+    pytest.importorskip("smax")
+
+    def compile_(config):
+        return compile_config(write_config(tmp_path/"daemon_config.json", config))
+    return compile_
+
+
+def problems(compile_, config):
+    with pytest.raises(ConfigError) as e:
+        compile_(config)
+    return e.value.problems
+
+
+def test_devices_are_compiled(compile_):
+    compiled = compile_(base_config(devices=[{"smax_key":"a", "logging_interval":2}, {"smax_key":"b"}]))
+    devices = compiled["devices"]
+    assert [d["smax_key"] for d in devices] == ["a", "b"]
+    assert devices[0]["config"]["logging_interval"] == 2
+    assert devices[1]["config"]["logging_interval"] == 1
+    assert devices[0]["config"]["logged_data"] == {"random_number":{"type":"float"}, "group:base":{"attribute":"random_base"}}
+
+
+@pytest.mark.parametrize("settings", [
+    {"concurrent_reads":5},
+    {"history":3},
+    {"load_shedding":[]},
+    {"publish_policy":"on_change"},
+    {"logged_data":[1]},
+    {"profiling":1},
+    {"devices":{"smax_key":"a"}},
+    {"devices":["a"]},
+])
+def test_malformed_sections_are_reported(compile_, settings):
+    assert len(problems(compile_, base_config(**settings))) == 1
+
+
+def test_unknown_logged_data_targets_are_reported(compile_):
+    config = base_config(logged_data={"no_such_attr":None,
+                                      "renamed":{"attribute":"random_rnage"},
+                                      "nested":{"attribute":"random_base.real"},
+                                      "called":{"function":"add_a_number", "args":[1]},
+                                      "interface":{"function":"random_range_plus_one"}})
+    assert problems(compile_, config) == ["device: logged_data no_such_attr: no_such_attr is not an attribute of the hardware",
+                                          "device: logged_data renamed: random_rnage is not an attribute of the hardware"]
+
+
+def test_unknown_control_targets_are_reported(compile_):
+    config = base_config()
+    config["smax_config"]["smax_control_keys"] = {
+        "ok":{"attribute":"random_range", "type":"float"},
+        "misspelled":{"attribute":"random_rnage"},
+        "not_a_function":{"function":"random_base"},
+        "not_an_attribute":{"attribute":"add_a_number"},
+        "callback":"set_random_base_callback",
+    }
+    assert [p.split(":")[1].strip() for p in problems(compile_, config)] == \
+        ["control key misspelled", "control key not_a_function", "control key not_an_attribute"]
+
+
+def test_publish_policy_settings_must_be_numbers(compile_):
+    assert len(problems(compile_, base_config(publish_policy={"deadband":"a"}))) == 1
+    assert len(problems(compile_, base_config(logged_data={"random_number":{"deadband_rel":"a"}}))) == 1
+
+
+class CountingCompiler:
+    """Stands in for compile_config, counting the compilations"""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, config_file, smax_config_file=None):
+        self.calls += 1
+        with open(config_file) as fp:
+            return {"config":json.load(fp), "devices":[]}
+
+
+@pytest.fixture
+def compiler(monkeypatch):
+    compiler = CountingCompiler()
+    monkeypatch.setattr(config_compiler, "compile_config", compiler)
+    return compiler
+
+
+def test_cache_is_reused_until_the_config_changes(tmp_path, compiler):
+    config_file = write_config(tmp_path/"daemon_config.json", {"logging_interval":1})
+    smax_config_file = write_config(tmp_path/"smax_config.json", SMAX_CONFIG)
+    cache_file = str(tmp_path/"cache.json")
+    assert load_config(config_file, smax_config_file, cache_file)["config"] == {"logging_interval":1}
+    assert load_config(config_file, smax_config_file, cache_file)["config"] == {"logging_interval":1}
+    assert compiler.calls == 1
+    # Touching a file without changing it checks its contents, and keeps the cache
+    stat = os.stat(config_file)
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    load_config(config_file, smax_config_file, cache_file)
+    assert compiler.calls == 1
+    write_config(config_file, {"logging_interval":2})
+    assert load_config(config_file, smax_config_file, cache_file)["config"] == {"logging_interval":2}
+    assert compiler.calls == 2
+    # A change to the SMA-X config also recompiles
+    write_config(smax_config_file, dict(SMAX_CONFIG, smax_db=1))
+    load_config(config_file, smax_config_file, cache_file)
+    assert compiler.calls == 3
+
+
+def test_cache_of_other_files_or_versions_is_ignored(tmp_path, compiler, monkeypatch):
+    config_file = write_config(tmp_path/"daemon_config.json", {"logging_interval":1})
+    other_file = write_config(tmp_path/"other_config.json", {"logging_interval":1})
+    cache_file = str(tmp_path/"cache.json")
+    load_config(config_file, cache_file=cache_file)
+    load_config(other_file, cache_file=cache_file)
+    assert compiler.calls == 2
+    monkeypatch.setattr(config_compiler, "CONFIG_CACHE_VERSION", config_compiler.CONFIG_CACHE_VERSION + 1)
+    load_config(other_file, cache_file=cache_file)
+    assert compiler.calls == 3
+
+
+def test_corrupt_cache_is_ignored(tmp_path, compiler):
+    config_file = write_config(tmp_path/"daemon_config.json", {"logging_interval":1})
+    cache_file = tmp_path/"cache.json"
+    cache_file.write_text('{"version":')
+    assert load_config(config_file, cache_file=str(cache_file))["config"] == {"logging_interval":1}
+    assert compiler.calls == 1
+    assert json.loads(cache_file.read_text())["version"] == config_compiler.CONFIG_CACHE_VERSION
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from connection_link import Link
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+class Reconnect:
+    """A reconnect function that fails a given number of times before succeeding"""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+        self.threads = []
+
+    def __call__(self):
+        self.calls += 1
+        self.threads.append(threading.current_thread().name)
+        if self.calls <= self.failures:
+            raise ConnectionError(f"attempt {self.calls} failed")
+
+
+def test_states():
+    link = Link("Test", Reconnect())
+    assert link.state == Link.RECONNECTING
+    link.connected()
+    assert (link.state, link.error) == (Link.CONNECTED, None)
+    link.degraded("one key failed")
+    assert (link.state, link.error) == (Link.DEGRADED, "one key failed")
+    link.connected()
+    assert (link.state, link.error) == (Link.CONNECTED, None)
+
+
+def test_lost_link_reconnects_in_the_background():
+    reconnect = Reconnect(failures=2)
+    link = Link("Test", reconnect, initial_delay=0.01, max_delay=0.02)
+    link.lost("connection refused")
+    assert link.losses == 1
+    wait_for(lambda: link.state == Link.CONNECTED)
+    assert reconnect.calls == 3
+    assert reconnect.threads == ["Test reconnect"]*3
+    assert link.error is None
+    wait_for(lambda: link._thread is None)
+
+
+def test_failed_attempts_keep_the_latest_error():
+    link = Link("Test", Reconnect(failures=1000), initial_delay=0.01, max_delay=0.01)
+    link.lost("connection refused")
+    wait_for(lambda: link.reconnect.calls >= 2)
+    assert link.state == Link.RECONNECTING
+    assert "failed" in link.error
+    link.close()
+    wait_for(lambda: link._thread is None)
+
+
+def test_lost_again_while_reconnecting_retries():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def reconnect():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+
+    link = Link("Test", reconnect, initial_delay=0.01)
+    link.lost("first")
+    assert started.wait(5)
+    # The attempt in progress was made before this loss, so it doesn't count
+    link.lost("second")
+    assert link.losses == 2
+    release.set()
+    wait_for(lambda: link.state == Link.CONNECTED)
+    assert len(calls) == 2
+
+
+def test_close_stops_reconnecting():
+    reconnect = Reconnect(failures=1000)
+    link = Link("Test", reconnect, initial_delay=0.01, max_delay=0.01)
+    link.lost("connection refused")
+    wait_for(lambda: reconnect.calls >= 1)
+    link.close()
+    wait_for(lambda: link._thread is None)
+    calls = reconnect.calls
+    time.sleep(0.05)
+    assert reconnect.calls == calls
@@ -0,0 +1,196 @@
+import json
+import logging
+
+import pytest
+
+# The daemon needs smax-python
+pytest.importorskip("smax")
+
+import example_smax_daemon
+from logging_scheduler import LoggingScheduler
+
+
+SMAX_CONFIG = {"smax_server":"localhost", "smax_port":6379, "smax_db":0, "smax_table":"test"}
+
+
+def daemon_config(**settings):
+    config = {
+        "logging_interval":1,
+        "logging_level":"WARNING",
+        "smax_config":{},
+        "logged_data":{"random_base":None, "random_range":None},
+        "config":{"random_base":0.0, "random_range":1.0},
+        "devices":[{"smax_key":"a"}, {"smax_key":"b"}],
+    }
+    config.update(settings)
+    return config
+
+
+class Message:
+    """A pub/sub message, as passed to control key callbacks"""
+    def __init__(self, data):
+        self.data = data
+        self.smaxname = "control"
+        self.origin = "test"
+        self.timestamp = 0
+
+
+class RecordingClient:
+    """Records smax_share calls in place of an SMA-X client, failing shares of structs with struct_error if given"""
+    def __init__(self, struct_error=None):
+        self.struct_error = struct_error
+        self.shares = []
+
+    def smax_share(self, table, key, value):
+        if self.struct_error is not None and isinstance(value, dict):
+            raise self.struct_error
+        self.shares.append((table, key, value))
+
+
+class Service:
+    """Creates an ExampleSmaxService from config dictionaries, with its hardware interfaces
+    created as start() does, but without connecting to SMA-X or running the main loop"""
+    def __init__(self, path):
+        self.path = path
+        self.config_file = str(path/"daemon_config.json")
+        self.smax_config_file = str(path/"smax_config.json")
+        with open(self.smax_config_file, "w") as fp:
+            json.dump(SMAX_CONFIG, fp)
+        self.service = None
+
+    def write(self, config):
+        config.setdefault("smax_buffer", {"path":str(self.path/"smax_buffer")})
+        with open(self.config_file, "w") as fp:
+            json.dump(config, fp)
+
+    def create(self, config):
+        self.write(config)
+        service = example_smax_daemon.ExampleSmaxService(config=self.config_file, smax_config=self.smax_config_file,
+                                                         config_cache=None)
+        for device in service.devices:
+            device.hardware = example_smax_daemon.HardwareInterface(config=device.config, logger=service.logger,
+                                                                    name=device.smax_key)
+        service.scheduler = LoggingScheduler(service.logging_groups())
+        self.service = service
+        return service
+
+    def close(self):
+        if self.service is not None:
+            for device in self.service.devices:
+                device.hardware.close()
+            self.service._stop_logging()
+            self.service = None
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # The daemon writes its log file to the working directory
+    monkeypatch.chdir(tmp_path)
+    service = Service(tmp_path)
+    yield service
+    service.close()
+
+
+def worker(device):
+    return device.hardware._commands._thread
+
+
+def test_reload_reconfigures_devices(service):
+    daemon = service.create(daemon_config())
+    a, b = daemon.devices
+    hardware = a.hardware
+    service.write(daemon_config(logging_interval=2, config={"random_base":5.0, "random_range":1.0}))
+    daemon.reload_config()
+    assert daemon.devices == [a, b]
+    assert a.hardware is hardware
+    assert a.hardware.read_hardware("random_base") == 5.0
+    assert set(daemon.logging_groups()) == {2}
+
+
+def test_reload_adds_and_removes_devices(service):
+    daemon = service.create(daemon_config())
+    a, b = daemon.devices
+    b.hardware.set_random_base_callback(Message(1.0))
+    assert worker(b).is_alive()
+    service.write(daemon_config(devices=[{"smax_key":"a"}, {"smax_key":"c"}]))
+    daemon.reload_config()
+    assert [d.smax_key for d in daemon.devices] == ["a", "c"]
+    assert daemon.devices[0] is a
+    # The removed device's command worker is stopped
+    assert not worker(b).is_alive()
+    assert b.hardware._hardware is None
+
+
+def test_reload_recreates_device_to_remove_settings(service):
+    daemon = service.create(daemon_config(history={"samples":5}))
+    a = daemon.devices[0]
+    hardware = a.hardware
+    hardware.set_random_base_callback(Message(1.0))
+    service.write(daemon_config())
+    daemon.reload_config()
+    assert a.hardware is not hardware
+    # The old interface's command worker is stopped
+    assert not hardware._commands._thread.is_alive()
+    assert a.hardware._commands._thread is None
+
+
+def test_invalid_reload_keeps_the_current_config(service):
+    daemon = service.create(daemon_config())
+    devices = list(daemon.devices)
+    service.write(daemon_config(logging_interval=-1))
+    daemon.reload_config()
+    assert daemon.devices == devices
+    assert daemon.logging_interval == 1
+
+
+def test_log_output_goes_through_the_queue(service, tmp_path):
+    root = logging.getLogger()
+    console = list(root.handlers)
+    daemon = service.create(daemon_config())
+    assert root.handlers == [daemon._log_queue_handler]
+    daemon.logger.warning("from the daemon")
+    logging.getLogger("other").warning("from another library")
+    service.close()
+    assert root.handlers == console
+    log = (tmp_path/"example_smax_daemon.log").read_text()
+    assert "from the daemon" in log
+    assert "from another library" not in log
+
+
+def test_batch_share_writes_one_struct(service):
+    daemon = service.create(daemon_config(smax_config={"batch_share":True}))
+    daemon.smax_client = RecordingClient()
+    device = daemon.devices[0]
+    daemon._smax_share(device, {"random_base":1.0, "group:value":2.0}, {"random_base":(10.0, 0.5), "group:value":(11.0, 0.25)})
+    assert daemon.smax_client.shares == [("test", "a", {
+        "random_base":1.0,
+        "group":{"value":2.0},
+        "_sample_times":{"acquired":{"random_base":10.0, "group":{"value":11.0}},
+                         "read_time":{"random_base":0.5, "group":{"value":0.25}}},
+    })]
+
+
+def test_batch_share_falls_back_to_each_value(service):
+    daemon = service.create(daemon_config(smax_config={"batch_share":True}))
+    daemon.smax_client = RecordingClient(struct_error=TypeError("can't share"))
+    device = daemon.devices[0]
+    daemon._smax_share(device, {"random_base":1.0, "group:value":2.0})
+    assert [share[2] for share in daemon.smax_client.shares] == [1.0, 2.0]
+    assert device.hardware.metrics.counters["batch_share_fallbacks"] == 1
+
+
+def test_batch_share_connection_errors_are_not_a_fallback(service):
+    daemon = service.create(daemon_config(smax_config={"batch_share":True}))
+    daemon.smax_client = RecordingClient(struct_error=example_smax_daemon.SmaxConnectionError("refused"))
+    device = daemon.devices[0]
+    with pytest.raises(example_smax_daemon.SmaxConnectionError):
+        daemon._smax_share(device, {"random_base":1.0})
+    assert daemon.smax_client.shares == []
+    assert "batch_share_fallbacks" not in device.hardware.metrics.counters
+
+
+def test_share_each_value(service):
+    daemon = service.create(daemon_config())
+    daemon.smax_client = RecordingClient()
+    daemon._smax_share(daemon.devices[0], {"random_base":1.0, "group:value":2.0})
+    assert [share[2] for share in daemon.smax_client.shares] == [1.0, 2.0]
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from daemon_profiler import Profiler
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture
+def threads():
+    """Start threads named "Busy", which spins, and "Idle", which waits"""
+    stop = threading.Event()
+    threads = [threading.Thread(target=spin, args=(stop,), name="Busy", daemon=True),
+               threading.Thread(target=stop.wait, name="Idle", daemon=True)]
+    for t in threads:
+        t.start()
+    yield
+    stop.set()
+    for t in threads:
+        t.join(5)
+
+
+def profile(tmp_path, **settings):
+    """Run a profile, returning its summary and whether a second profile could be started while it ran"""
+    done = threading.Event()
+    summaries = []
+
+    def on_done(summary):
+        summaries.append(summary)
+        done.set()
+
+    profiler = Profiler(str(tmp_path), "test", on_done=on_done)
+    assert profiler.start(**settings)
+    assert profiler.running
+    started_again = profiler.start(**settings)
+    assert done.wait(10)
+    return summaries[0], started_again
+
+
+def test_profile_of_busy_thread(tmp_path, threads):
+    summary, started_again = profile(tmp_path, duration=0.2, interval=0.002, threads=["Busy"], memory=True)
+    assert not started_again
+    assert summary["samples"] > 0
+    assert summary["idle_samples"] == 0
+    assert any(line.split("% ", 1)[1].startswith("spin (") for line in summary["top_total"])
+    assert "memory_top" in summary
+    txt, folded = summary["files"]
+    assert txt.startswith(str(tmp_path)) and folded.endswith(".folded")
+    with open(folded) as fp:
+        lines = fp.read().splitlines()
+    assert lines
+    assert all(line.startswith("Busy;") for line in lines)
+    with open(txt) as fp:
+        assert fp.readline().startswith("Profile started")
+
+
+def test_waiting_threads_count_as_idle(tmp_path, threads):
+    summary, _ = profile(tmp_path, duration=0.1, interval=0.002, threads=["Idle"], memory=False)
+    assert summary["samples"] > 0
+    assert summary["idle_samples"] == summary["samples"]
+    assert summary["top_own"] == []
+    assert "memory_top" not in summary
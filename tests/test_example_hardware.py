@@ -0,0 +1,23 @@
+import time
+
+from example_smax_hardware import ExampleHardware
+
+
+def test_configure_applies_settings():
+    hardware = ExampleHardware(config={"random_base":1.0, "_random_range":2.0})
+    assert hardware.random_base == 1.0
+    assert hardware.random_range == 2.0
+    assert 1.0 <= hardware.random_number() <= 3.0
+
+
+def test_configure_delays_once():
+    hardware = ExampleHardware(config={"_config_delay":0.05})
+    start = time.perf_counter()
+    hardware.configure({"random_base":1.0, "random_range":2.0})
+    elapsed = time.perf_counter() - start
+    # The setters would each delay as well if they were called one at a time
+    assert 0.05 <= elapsed < 0.1
+    assert hardware._config_delay == 0.05
+    start = time.perf_counter()
+    hardware.random_base = 3.0
+    assert time.perf_counter() - start >= 0.05
@@ -0,0 +1,91 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+# The hardware interface needs smax-python, as the daemon does
+pytest.importorskip("smax")
+
+from example_hardware_interface import ExampleHardwareInterface, flatten_logged_data
+
+
+logger = logging.getLogger("test_hardware_interface")
+# The daemon adds a STATUS level between INFO and WARNING
+logger.status = logger.info
+
+
+def make_interface(logged_data, **config):
+    """Create an interface to an in-process ExampleHardware, logging logged_data"""
+    config.setdefault("logging_interval", 1)
+    config.setdefault("config", {"random_base":1.0, "random_range":2.0})
+    return ExampleHardwareInterface(config=dict(config, logged_data=logged_data), logger=logger)
+
+
+def test_flatten_logged_data():
+    logged_data = {
+        "plain":None,
+        "empty":{},
+        "leaf":{"type":"float", "channel":3},
+        "receiver":{"channel":{"type":"float"}, "temp":{"interval":2}, "deep":{"a":None}},
+    }
+    assert flatten_logged_data(logged_data) == {
+        "plain":None,
+        "empty":{},
+        "leaf":{"type":"float", "channel":3},
+        "receiver:channel":{"type":"float"},
+        "receiver:temp":{"interval":2},
+        "receiver:deep:a":None,
+    }
+
+
+def test_history_is_kept_for_the_keys_read():
+    interface = make_interface({"base":{"attribute":"random_base", "history":5},
+                                "range":{"attribute":"random_range", "history":5},
+                                "number":{"function":"random_number"}})
+    for _ in range(7):
+        interface.logging_action(["base", "number"])
+    assert interface.history("base")["value"] == [1.0]*5
+    assert interface.history("range")["value"] == []
+    with pytest.raises(KeyError):
+        interface.history("number")
+
+
+def test_control_targets_are_checked_before_connecting(caplog):
+    interface = ExampleHardwareInterface(config={"config":{"random_base":1.0}}, logger=logger)
+    interface.disconnect_hardware()
+    message = SimpleNamespace(smaxname="control", origin="test", data=2.0, timestamp=0)
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        interface.control_callback("misspelled", {"attribute":"random_rnage"})(message)
+        interface.control_callback("not_a_function", {"function":"random_base"})(message)
+    errors = [r.getMessage() for r in caplog.records if r.levelno == logging.ERROR]
+    assert len(errors) == 4
+    assert "Could not resolve control key misspelled" in errors[0]
+    assert "rejected" in errors[1]
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        interface.control_callback("range", {"attribute":"random_range", "type":"float"})
+    assert not [r for r in caplog.records if r.levelno == logging.ERROR]
+
+
+def test_logging_plan_resolves_each_entry_once():
+    interface = make_interface({"random_base":None,
+                                "offset":{"function":"add_a_number", "args":3},
+                                "random_base_minus_one":{},
+                                "group:random_range":{"attribute":"random_range", "cache":False},
+                                "missing":{"attribute":"no_such_attr"}})
+    index = interface._plan_index
+    assert list(index) == ["random_base", "offset", "random_base_minus_one", "group:random_range", "missing"]
+    # Plain hardware attributes go through the read cache, unless it is turned off for the entry
+    assert index["random_base"].read.func == interface._read_cache.get
+    assert index["group:random_range"].read() == 2.0
+    # Methods are bound with their arguments, and the interface's own attributes take precedence
+    assert index["offset"].read.args == (3,)
+    assert index["random_base_minus_one"].read.args == (interface,)
+    assert interface._resolved_keys == {"random_base", "offset", "random_base_minus_one", "group:random_range"}
+
+    readings = interface.logging_action()
+    assert readings["random_base"] == 1.0
+    assert readings["random_base_minus_one"] == 0.0
+    assert 4.0 <= readings["offset"] <= 6.0
+    assert "missing" not in readings
+    assert readings["comm_bad_keys"] == "missing"
@@ -0,0 +1,60 @@
+import pytest
+
+from example_smax_hardware import ExampleHardware
+from hardware_proxy import HardwareProxy, HardwareTimeoutError, HardwareWorkerError
+
+
+@pytest.fixture
+def proxy():
+    proxy = HardwareProxy(ExampleHardware, config={"random_base":1.0, "random_range":0.0}, timeout=5)
+    yield proxy
+    proxy.close()
+
+
+def test_requests_are_forwarded(proxy):
+    assert proxy.random_base == 1.0
+    proxy.random_range = 2.0
+    assert proxy.random_range == 2.0
+    assert 43.0 <= proxy.add_a_number(42) <= 45.0
+    proxy.configure({"random_base":5.0})
+    assert proxy.random_base == 5.0
+    assert proxy.has_method("random_number")
+    assert not proxy.has_method("random_base")
+    with pytest.raises(AttributeError):
+        proxy.has_method("no_such_attr")
+
+
+def test_hardware_errors_are_raised(proxy):
+    with pytest.raises(TypeError):
+        proxy.add_a_number()
+    # The worker carries on after an error
+    assert proxy.random_base == 1.0
+    assert proxy.restarts == 0
+
+
+def test_worker_that_times_out_is_restarted_and_reconfigured():
+    proxy = HardwareProxy(ExampleHardware, config={"random_base":1.0}, timeout=1)
+    try:
+        proxy.configure({"random_base":3.0, "_delay":10.0})
+        with pytest.raises(HardwareTimeoutError):
+            proxy.random_number()
+        assert proxy.random_base == 3.0
+        assert proxy.restarts == 1
+    finally:
+        proxy.close()
+
+
+def test_worker_that_dies_is_restarted(proxy):
+    proxy._proxy_process.kill()
+    proxy._proxy_process.join(5)
+    with pytest.raises(HardwareWorkerError):
+        proxy.random_base
+    assert proxy.random_base == 1.0
+    assert proxy.restarts == 1
+
+
+def test_closed_proxy_refuses_requests(proxy):
+    proxy.close()
+    assert proxy._proxy_process is None
+    with pytest.raises(HardwareWorkerError):
+        proxy.random_base
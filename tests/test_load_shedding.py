@@ -0,0 +1,90 @@
+from load_shedding import LoadShedder
+
+
+def overrun(shedder, interval=1):
+    """Report a cycle well over the budget"""
+    return shedder.update(10*interval*shedder.backoff, interval)
+
+
+def good(shedder, cycles, interval=1):
+    """Report cycles well inside the budget, returning the results"""
+    return [shedder.update(0, interval) for _ in range(cycles)]
+
+
+def test_sheds_lowest_priority_first():
+    shedder = LoadShedder(budget=0.5)
+    shedder.set_priorities([2, 0, 1, 1])
+    assert shedder.priorities == [0, 1, 2]
+    assert shedder.min_priority == 0
+    assert overrun(shedder) is False
+    assert shedder.min_priority == 1
+    assert overrun(shedder) is False
+    assert shedder.min_priority == 2
+    assert shedder.backoff == 1
+
+
+def test_backs_off_once_only_highest_priority_is_left():
+    shedder = LoadShedder(budget=0.5, max_backoff=4)
+    shedder.set_priorities([0, 1])
+    overrun(shedder)
+    assert overrun(shedder) is True
+    assert shedder.backoff == 2
+    assert overrun(shedder) is True
+    assert shedder.backoff == 4
+    # Already at the limit
+    assert overrun(shedder) is False
+    assert shedder.backoff == 4
+
+
+def test_budget_scales_with_backoff():
+    shedder = LoadShedder(budget=0.5, max_backoff=4)
+    overrun(shedder)
+    assert shedder.backoff == 2
+    # 0.9 s is over the budget of a 1 s interval, but not of the backed off 2 s interval
+    assert shedder.update(0.9, 1) is False
+    assert shedder.backoff == 2
+
+
+def test_cycles_near_budget_do_not_recover():
+    shedder = LoadShedder(budget=0.5, recover_cycles=2)
+    shedder.set_priorities([0, 1])
+    overrun(shedder)
+    for _ in range(10):
+        shedder.update(0.3, 1)
+    assert shedder.shed == 1
+
+
+def test_recovers_backoff_then_shedding():
+    shedder = LoadShedder(budget=0.5, max_backoff=4, recover_cycles=2)
+    shedder.set_priorities([0, 1])
+    overrun(shedder)
+    overrun(shedder)
+    overrun(shedder)
+    assert (shedder.shed, shedder.backoff) == (1, 4)
+    assert good(shedder, 2) == [False, True]
+    assert shedder.backoff == 2
+    assert good(shedder, 2) == [False, True]
+    assert shedder.backoff == 1
+    assert good(shedder, 2) == [False, False]
+    assert shedder.shed == 0
+    assert shedder.min_priority == 0
+
+
+def test_failed_recovery_waits_longer():
+    shedder = LoadShedder(budget=0.5, max_backoff=4, recover_cycles=2)
+    shedder.set_priorities([0, 1])
+    overrun(shedder)
+    overrun(shedder)
+    overrun(shedder)
+    assert good(shedder, 2) == [False, True]
+    assert shedder.backoff == 2
+    # The recovery step overran, so the next one waits for twice as many good cycles
+    assert overrun(shedder) is True
+    assert shedder.backoff == 4
+    assert good(shedder, 4) == [False, False, False, True]
+    assert shedder.backoff == 2
+    # The step is known to have held when the next one is due, after which the wait goes back to normal
+    assert good(shedder, 4) == [False, False, False, True]
+    assert shedder.backoff == 1
+    assert good(shedder, 2) == [False, False]
+    assert shedder.shed == 0
@@ -0,0 +1,145 @@
+import pytest
+
+from logging_scheduler import LoggingScheduler
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_groups_are_due_immediately(clock):
+    scheduler = LoggingScheduler({1:["a", "b"], 5:["c"]}, clock=clock)
+    assert sorted(scheduler.pop_due()) == ["a", "b", "c"]
+    assert scheduler.pop_due() == []
+    assert scheduler.time_to_next() == pytest.approx(1)
+
+
+def test_each_group_keeps_its_interval(clock):
+    scheduler = LoggingScheduler({1:["fast"], 3:["slow"]}, clock=clock)
+    due = []
+    for t in range(7):
+        clock.now = t
+        due.append(sorted(scheduler.pop_due()))
+    assert due == [["fast", "slow"], ["fast"], ["fast"], ["fast", "slow"], ["fast"], ["fast"], ["fast", "slow"]]
+    assert scheduler.overruns == 0
+
+
+def test_empty_groups_are_not_scheduled(clock):
+    scheduler = LoggingScheduler({1:[]}, clock=clock)
+    assert scheduler.time_to_next() is None
+    assert scheduler.pop_due() == []
+
+
+def test_deadlines_do_not_drift(clock):
+    scheduler = LoggingScheduler({0.1:["a"]}, clock=clock)
+    scheduler.pop_due()
+    # Reads that are always a little late don't push the schedule back
+    for slot in range(1, 1001):
+        clock.now = slot*0.1 + 0.01
+        assert scheduler.pop_due() == ["a"]
+    assert scheduler.time_to_next() == pytest.approx(0.09)
+    assert scheduler.overruns == 0
+
+
+def test_overrun_skips_missed_slots(clock):
+    scheduler = LoggingScheduler({1:["a"]}, clock=clock)
+    scheduler.pop_due()
+    # The slots at 1, 2 and 3 have all passed, but the group is only read once
+    clock.now = 3.5
+    assert scheduler.pop_due() == ["a"]
+    assert scheduler.overruns == 2
+    assert scheduler.last_due == 1
+    assert scheduler.time_to_next() == pytest.approx(0.5)
+    clock.now = 4
+    assert scheduler.pop_due() == ["a"]
+    assert scheduler.overruns == 2
+
+
+def test_reset_makes_everything_due(clock):
+    scheduler = LoggingScheduler({10:["a"]}, clock=clock)
+    scheduler.pop_due()
+    clock.now = 1
+    scheduler.reset({10:["a"], 20:["b"]})
+    assert sorted(scheduler.pop_due()) == ["a", "b"]
+
+
+def test_update_keeps_unchanged_intervals(clock):
+    scheduler = LoggingScheduler({10:["a"], 60:["b"]}, clock=clock)
+    scheduler.pop_due()
+    clock.now = 5
+    scheduler.update({10:["a", "c"], 60:["b"]})
+    # "c" joins the 10 s group, which is still due at 10
+    assert scheduler.pop_due() == []
+    assert scheduler.time_to_next() == pytest.approx(5)
+    clock.now = 10
+    assert sorted(scheduler.pop_due()) == ["a", "c"]
+
+
+def test_update_carries_changed_intervals_forward(clock):
+    scheduler = LoggingScheduler({10:["a"], 60:["b"]}, clock=clock)
+    scheduler.pop_due()
+    clock.now = 10
+    assert scheduler.pop_due() == ["a"]
+    scheduler.update({20:["a"], 60:["b"]})
+    # "a" was last read at 10, so it is next due one new interval later, not immediately
+    assert scheduler.pop_due() == []
+    assert scheduler.time_to_next() == pytest.approx(20)
+    clock.now = 30
+    assert scheduler.pop_due() == ["a"]
+    clock.now = 50
+    assert scheduler.pop_due() == ["a"]
+    clock.now = 60
+    assert scheduler.pop_due() == ["b"]
+
+
+def test_update_makes_a_shortened_interval_due_immediately_if_passed(clock):
+    scheduler = LoggingScheduler({60:["a"]}, clock=clock)
+    scheduler.pop_due()
+    clock.now = 30
+    scheduler.update({10:["a"]})
+    assert scheduler.pop_due() == ["a"]
+
+
+def test_update_makes_new_keys_due_immediately(clock):
+    scheduler = LoggingScheduler({10:["a"]}, clock=clock)
+    scheduler.pop_due()
+    clock.now = 1
+    scheduler.update({10:["a"], 5:["new"]})
+    assert scheduler.pop_due() == ["new"]
+
+
+def test_alignment_to_wall_clock(clock):
+    scheduler = LoggingScheduler({1:["a"], 10:["b"]}, clock=clock, wall_clock=lambda: 1000.25 + clock.now)
+    # The wall clock is at 1000.25, so "a" is first due at 1001 and "b" at 1010
+    assert scheduler.pop_due() == []
+    assert scheduler.time_to_next() == pytest.approx(0.75)
+    clock.now = 0.75
+    assert scheduler.pop_due() == ["a"]
+    for t in range(1, 9):
+        clock.now = t + 0.75
+        assert scheduler.pop_due() == ["a"]
+    clock.now = 9.75
+    assert sorted(scheduler.pop_due()) == ["a", "b"]
+    assert scheduler.last_due == pytest.approx(9.75)
+    assert scheduler.overruns == 0
+
+
+def test_alignment_of_updated_intervals(clock):
+    scheduler = LoggingScheduler({10:["a"]}, clock=clock, wall_clock=lambda: 1000 + clock.now)
+    assert scheduler.pop_due() == ["a"]
+    clock.now = 2
+    scheduler.update({10:["a"], 5:["b"]})
+    # "b" is new, and waits for its next 5 s boundary at wall clock 1005
+    assert scheduler.time_to_next() == pytest.approx(3)
+    clock.now = 5
+    assert scheduler.pop_due() == ["b"]
@@ -0,0 +1,67 @@
+import pytest
+
+from publish_policy import PublishPolicy
+
+
+def test_from_config():
+    default = PublishPolicy.from_config({"publish":"on_change", "max_silence":60})
+    assert PublishPolicy.from_config(None, default) is default
+    assert PublishPolicy.from_config({"type":"float"}, default) is default
+    policy = PublishPolicy.from_config({"deadband":0.1})
+    assert (policy.mode, policy.deadband) == ("on_change", 0.1)
+    policy = PublishPolicy.from_config({"publish":"always"}, default)
+    assert (policy.mode, policy.max_silence) == ("always", 60)
+    with pytest.raises(ValueError):
+        PublishPolicy.from_config({"publish":"sometimes"})
+
+
+@pytest.mark.parametrize("entry", [{"deadband":"a"}, {"deadband_rel":-1}, {"max_silence":True}])
+def test_settings_must_be_numbers(entry):
+    with pytest.raises(ValueError):
+        PublishPolicy.from_config(entry)
+
+
+def test_always():
+    policy = PublishPolicy()
+    assert policy.should_publish(1, [1, 0], 1)
+
+
+def test_on_change():
+    policy = PublishPolicy("on_change")
+    assert policy.should_publish(1, None, 0)
+    assert not policy.should_publish(1, [1, 0], 1)
+    assert policy.should_publish(2, [1, 0], 1)
+    assert policy.should_publish("b", ["a", 0], 1)
+    assert not policy.should_publish(True, [True, 0], 1)
+
+
+def test_deadbands():
+    policy = PublishPolicy("on_change", deadband=0.5)
+    assert not policy.should_publish(1.4, [1.0, 0], 1)
+    assert policy.should_publish(1.6, [1.0, 0], 1)
+    policy = PublishPolicy("on_change", deadband_rel=0.1)
+    assert not policy.should_publish(105, [100, 0], 1)
+    assert policy.should_publish(111, [100, 0], 1)
+
+
+def test_nan():
+    nan = float("nan")
+    policy = PublishPolicy("on_change", deadband=0.5)
+    assert policy.should_publish(nan, [1.0, 0], 1)
+    assert not policy.should_publish(nan, [nan, 0], 1)
+    assert policy.should_publish(1.0, [nan, 0], 1)
+
+
+def test_max_silence():
+    policy = PublishPolicy("on_change", max_silence=10)
+    assert not policy.should_publish(1, [1, 0], 9)
+    assert policy.should_publish(1, [1, 0], 10)
+    assert policy.should_publish(float("nan"), [float("nan"), 0], 10)
+
+
+def test_values_that_do_not_compare():
+    class Uncomparable:
+        def __ne__(self, other):
+            raise ValueError("ambiguous")
+
+    assert PublishPolicy("on_change").should_publish(Uncomparable(), [Uncomparable(), 0], 1)
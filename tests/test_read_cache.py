@@ -0,0 +1,45 @@
+from read_cache import ReadCache
+
+
+class Counting:
+    """An object whose attribute counts how many times it has been read"""
+    def __init__(self):
+        self.reads = 0
+
+    @property
+    def value(self):
+        self.reads += 1
+        return self.reads
+
+
+def test_reuses_values_within_a_sweep():
+    obj = Counting()
+    cache = ReadCache()
+    assert cache.get(obj, "value") == 1
+    assert cache.get(obj, "value") == 1
+    cache.new_sweep()
+    assert cache.get(obj, "value") == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("read_cache.time.monotonic", lambda: now[0])
+    obj = Counting()
+    cache = ReadCache(ttl=1)
+    cache.get(obj, "value")
+    cache.new_sweep()
+    now[0] = 0.5
+    assert cache.get(obj, "value") == 1
+    now[0] = 1.5
+    assert cache.get(obj, "value") == 2
+
+
+def test_invalidate():
+    obj = Counting()
+    cache = ReadCache()
+    cache.get(obj, "value")
+    cache.invalidate(["value"])
+    assert cache.get(obj, "value") == 2
+    cache.invalidate()
+    assert cache.get(obj, "value") == 3
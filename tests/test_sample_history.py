@@ -0,0 +1,75 @@
+import pytest
+
+import sample_history
+from sample_history import SampleHistory
+
+
+@pytest.fixture(params=["numpy", "python"])
+def numpy_or_not(request, monkeypatch):
+    """Run a test with NumPy, if it is installed, and without"""
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(sample_history, "np", None)
+
+
+def filled(n, size=10):
+    history = SampleHistory(size)
+    for i in range(n):
+        history.append(float(i), i*10.0)
+    return history
+
+
+def test_keeps_the_latest_samples():
+    history = filled(3)
+    assert len(history) == 3
+    assert list(history.window()[1]) == [0, 10, 20]
+    history = filled(25)
+    assert len(history) == 10
+    assert history.count == 25
+    times, values = history.window()
+    assert list(times) == [float(i) for i in range(15, 25)]
+    assert list(values) == [i*10.0 for i in range(15, 25)]
+
+
+def test_rejects_non_numbers():
+    with pytest.raises(TypeError):
+        SampleHistory(2).append(0, "high")
+
+
+def test_window():
+    history = filled(25)
+    times, values = history.window(17, 19.5)
+    assert list(times) == [17, 18, 19]
+    assert list(values) == [170, 180, 190]
+    assert list(history.window(start=23)[0]) == [23, 24]
+    assert list(history.window(end=15)[0]) == [15]
+    assert list(history.window(30, 40)[0]) == []
+
+
+def test_aggregate(numpy_or_not):
+    history = filled(10)
+    result = history.aggregate(2, 0, 10)
+    assert result == {"time":[0, 5], "mean":[20, 70], "min":[0, 50], "max":[40, 90], "count":[5, 5]}
+
+
+def test_aggregate_leaves_out_empty_bins(numpy_or_not):
+    history = SampleHistory(10)
+    for t in (0, 1, 8, 9):
+        history.append(t, t)
+    result = history.aggregate(5)
+    assert result["time"] == [0, 7.2]
+    assert result["count"] == [2, 2]
+    assert result["mean"] == [0.5, 8.5]
+
+
+def test_aggregate_of_nothing(numpy_or_not):
+    assert SampleHistory(4).aggregate(3) == {"time":[], "mean":[], "min":[], "max":[], "count":[]}
+
+
+def test_aggregate_single_sample(numpy_or_not):
+    history = SampleHistory(4)
+    history.append(5, 1.5)
+    result = history.aggregate(3)
+    assert result["count"] == [1]
+    assert result["mean"] == [1.5]
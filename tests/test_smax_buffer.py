@@ -0,0 +1,81 @@
+from smax_buffer import WriteAheadBuffer
+
+
+def test_records_are_read_oldest_first(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path), segment_records=3)
+    for i in range(5):
+        buffer.append([i, "key", {"value":i}])
+    assert len(buffer) == 5
+    # Reads stop at the end of the oldest segment
+    assert [r[0] for r in buffer.read(10)] == [0, 1, 2]
+    # Reading doesn't remove anything
+    assert [r[0] for r in buffer.read(2)] == [0, 1]
+    buffer.consume(2)
+    assert [r[0] for r in buffer.read(10)] == [2]
+    buffer.consume(1)
+    assert [r[0] for r in buffer.read(10)] == [3, 4]
+    buffer.consume(2)
+    assert len(buffer) == 0
+    assert buffer.read(10) == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_records_survive_a_restart(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path), segment_records=2)
+    for i in range(3):
+        buffer.append([i])
+    buffer.close()
+    buffer = WriteAheadBuffer(str(tmp_path), segment_records=2)
+    assert len(buffer) == 3
+    assert buffer.read(10) == [[0], [1]]
+    buffer.append([3])
+    buffer.consume(2)
+    assert buffer.read(10) == [[2]]
+    buffer.consume(1)
+    # New records go in a new segment after a restart
+    assert buffer.read(10) == [[3]]
+
+
+def test_full_buffer_drops_oldest_segment(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path), max_records=4, segment_records=2)
+    for i in range(7):
+        buffer.append([i])
+    # Starting a third segment dropped the first, and starting a fourth the second
+    assert buffer.dropped == 4
+    assert len(buffer) == 3
+    assert buffer.read(10) == [[4], [5]]
+
+
+def test_consume_after_read_segment_was_dropped(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path), max_records=4, segment_records=2)
+    for i in range(4):
+        buffer.append([i])
+    assert buffer.read(2) == [[0], [1]]
+    # Appending while the records are being replayed drops the segment they were read from
+    buffer.append([4])
+    assert buffer.dropped == 2
+    buffer.consume(2)
+    # The next segment is untouched
+    assert buffer.read(10) == [[2], [3]]
+
+
+def test_values_json_can_not_store_are_converted(tmp_path):
+    class Array:
+        def tolist(self):
+            return [1.0, 2.0]
+
+    buffer = WriteAheadBuffer(str(tmp_path))
+    buffer.append([0, {"block":Array(), "other":object}])
+    record = buffer.read(1)[0]
+    assert record[1]["block"] == [1.0, 2.0]
+    assert record[1]["other"] == repr(object)
+
+
+def test_partial_line_is_read_as_none(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path))
+    buffer.append([0])
+    buffer.close()
+    with open(next(tmp_path.iterdir()), "a") as fp:
+        fp.write('[1, "trunc')
+    buffer = WriteAheadBuffer(str(tmp_path))
+    assert buffer.read(10) == [[0], None]